@@ -9,6 +9,8 @@ from flask_pagedown import PageDown
 
 # local import
 from config import config
+from .cache import user_cache
+from .storage import storage
 
 # database variable db initialization
 db = SQLAlchemy()
@@ -29,6 +31,14 @@ def create_app(config_name):
     moment.init_app(app)
     pagedown.init_app(app)
     login_manager.init_app(app)
+    user_cache.init_app(app, 'USER_CACHE')
+    storage.init_app(app)
+
+    from .utils import init_image_pool
+    init_image_pool(app)
+
+    from .resize import resize_cache
+    resize_cache.init_app(app)
 
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
@@ -1,10 +1,13 @@
 import os
-from flask import render_template, redirect, url_for, flash, request
+from flask import render_template, redirect, url_for, flash, request, jsonify
 from flask_login import login_required
 from . import admin
 from .forms import AddUser, UserProfileUpdate
 from ..models import User, Role
 from .. import database
+from ..cache import user_cache
+from ..storage import storage, presign_cache
+from ..resize import resize_cache
 from ..utils import send_email, admin_required, random_string
 
 
@@ -70,6 +73,7 @@ def edit_user(id):
         user.title = form.title.data
         user.role = Role.query.get(form.role.data)
         database.update(user)
+        user_cache.invalidate(user.id)
         ###
         # TODO - Send user an email with update
         ###
@@ -82,7 +86,7 @@ def edit_user(id):
         form.email.data = user.email
         form.title.data = user.title
         form.role.data = user.role_id
-    picture_file = url_for('static', filename='images/profile_img/' + user.profile_image)
+    picture_file = storage.url(user.profile_image)
     return render_template('admin/edit_user.html', form=form, user=user, image_file=picture_file, admin_email=os.environ.get('LAB_ADMIN'))
 
 
@@ -94,6 +98,7 @@ def all_users():
     Admin View - all users data
     """
     users = User.query.order_by(User.id.desc()).all()
+    storage.sign({user.profile_image for user in users})
     return render_template('/admin/users.html', users=users)
 
 
@@ -105,3 +110,33 @@ def user_profile(id):
     """
     user = User.query.get_or_404(id)
     return render_template('admin/user_profile.html', user=user)
+
+
+@admin.route('/cache')
+@login_required
+@admin_required
+def cache_stats():
+    """
+    Admin View - per-worker user cache hit rate
+    """
+    return jsonify(user_cache.stats())
+
+
+@admin.route('/image-cache')
+@login_required
+@admin_required
+def image_cache_stats():
+    """
+    Admin View - per-worker hit rate and bytes of the resized image cache
+    """
+    return jsonify(resize_cache.stats())
+
+
+@admin.route('/url-cache')
+@login_required
+@admin_required
+def url_cache_stats():
+    """
+    Admin View - per-worker hit rate of the presigned URL cache
+    """
+    return jsonify(presign_cache.stats())
@@ -0,0 +1,113 @@
+import threading
+import time
+
+
+class TTLCache:
+    """
+    Thread-safe per-worker cache of immutable values with time to live
+    Hits and misses are counted to tune the ttl
+    """
+
+    def __init__(self, ttl=60, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app, prefix):
+        """
+        Read ttl and maxsize from app config with given prefix eg- USER_CACHE
+        """
+        self.ttl = app.config.get(prefix + '_TTL', self.ttl)
+        self.maxsize = app.config.get(prefix + '_MAXSIZE', self.maxsize)
+
+    def get(self, key, loader):
+        """
+        Cached value of key, loader(key) is called on a miss
+        None is returned but never cached
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = loader(key)
+        if value is not None:
+            with self.lock:
+                if len(self.values) >= self.maxsize:
+                    self.evict(now)
+                self.values[key] = (now + self.ttl, value)
+        return value
+
+    def get_many(self, keys, loader):
+        """
+        Cached values of keys, loader(missing keys) is called once with every
+        missed key and returns {key: value}
+        returns {key: value}
+        """
+        now = time.monotonic()
+        values = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                entry = self.values.get(key)
+                if entry is not None and entry[0] > now:
+                    values[key] = entry[1]
+                else:
+                    missing.append(key)
+            self.hits += len(values)
+            self.misses += len(missing)
+        if missing:
+            loaded = loader(missing)
+            with self.lock:
+                if len(self.values) + len(loaded) > self.maxsize:
+                    self.evict(now)
+                for key, value in loaded.items():
+                    if value is not None:
+                        self.values[key] = (now + self.ttl, value)
+            values.update(loaded)
+        return values
+
+    def evict(self, now):
+        """
+        Drop expired entries, or the oldest half if none expired
+        caller must hold the lock
+        """
+        expired = [key for key, entry in self.values.items() if entry[0] <= now]
+        if not expired:
+            by_age = sorted(self.values, key=lambda key: self.values[key][0])
+            expired = by_age[:len(by_age) // 2 or 1]
+        for key in expired:
+            del self.values[key]
+
+    def invalidate(self, key):
+        """
+        Remove one key, used when the underlying row changes
+        """
+        with self.lock:
+            self.values.pop(key, None)
+
+    def clear(self):
+        """
+        Remove every key
+        """
+        with self.lock:
+            self.values.clear()
+
+    def stats(self):
+        """
+        Cache hits, misses, hit rate and size
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': round(self.hits / total, 4) if total else 0.0,
+                    'size': len(self.values)}
+
+
+user_cache = TTLCache()
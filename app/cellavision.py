@@ -0,0 +1,183 @@
+import io
+import mimetypes
+import os
+import posixpath
+import re
+import tarfile
+import zipfile
+from collections import Counter as Tally
+from werkzeug.datastructures import FileStorage
+from . import db, sprites
+from .models import CellImage, Event, Sample, Smear, SmearClassCount, PackEntry
+from .utils import store_images, wbc_classification, OrderEventType, Pack
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff'}
+
+# CellaVision cell class folders that do not match wbc_classification names
+CLASS_ALIASES = {
+    'neutrophil': 'neutrophils',
+    'segmented_neutrophils': 'neutrophils',
+    'band_neutrophils': 'neutrophils',
+    'lymphocyte': 'lymphocytes',
+    'variant_form_lymphocytes': 'lymphocytes',
+    'monocyte': 'monocytes',
+    'basophil': 'basophils',
+    'eosinophil': 'eosinophils',
+    'promyelocytes': 'immature_granulocytes',
+    'myelocytes': 'immature_granulocytes',
+    'metamyelocytes': 'immature_granulocytes',
+    'immature_granulocyte': 'immature_granulocytes',
+    'blast': 'blasts',
+    'not_classified': 'unclassified',
+    'plasma_cells': 'unclassified',
+    'erythroblasts': 'nrbcs',
+    'nrbc': 'nrbcs',
+    'smudge_cell': 'smudge_cells',
+    'artefacts': 'unidentified',
+    'giant_thrombocytes': 'unidentified',
+    'platelet_aggregates': 'unidentified',
+}
+
+
+def cell_class(path):
+    """
+    Class index of an exported image from the name of its nearest
+    folder that names a cell class, 0 = unidentified if none does
+    """
+    classification = wbc_classification()
+    for folder in reversed(posixpath.dirname(path).split('/')):
+        name = re.sub(r'[^a-z0-9]+', '_', folder.lower()).strip('_')
+        name = CLASS_ALIASES.get(name, name)
+        if name in classification:
+            return classification.index(name)
+    return 0
+
+
+def is_image(path):
+    """
+    Image files of an export, hidden files and folders are skipped
+    """
+    parts = path.split('/')
+    if any(part.startswith('.') or part == '__MACOSX' for part in parts):
+        return False
+    return posixpath.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def iter_archive(fileobj):
+    """
+    Yield (path, bytes) of every image of a zip or tar archive
+    Only one image is held in memory, tar archives are read as a stream
+    and zip archives member by member from their central directory
+    """
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as archive:
+            for member in archive.infolist():
+                if not member.filename.endswith('/') and is_image(member.filename):
+                    yield member.filename, archive.read(member)
+    else:
+        fileobj.seek(0)
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile() and is_image(member.name):
+                    yield member.name, archive.extractfile(member).read()
+
+
+def iter_directory(directory):
+    """
+    Yield (path, bytes) of every image of an export folder,
+    paths are relative to the folder and use / as separator
+    """
+    for root, folders, files in os.walk(directory):
+        folders.sort()
+        for name in sorted(files):
+            path = os.path.relpath(os.path.join(root, name), directory).replace(os.sep, '/')
+            if is_image(path):
+                with open(os.path.join(root, name), 'rb') as f:
+                    yield path, f.read()
+
+
+def import_archive(app, fileobj, user_id, smear=None):
+    """
+    Import a CellaVision export archive into smears, see import_images
+    """
+    return import_images(app, iter_archive(fileobj), user_id, smear)
+
+
+def import_images(app, images, user_id, smear=None):
+    """
+    Import (path, bytes) of a CellaVision export into smears
+    With a smear, every image of the export belongs to it. Without, the
+    export is a batch and the first folder of each image is the sample id.
+    Images are resized and uploaded INGEST_CHUNK at a time, images already
+    in their smear or earlier in the export are rejected as duplicates, with
+    SMEAR_PACK the images of a chunk are stored as one pack. Then every
+    CellImage row is written with a single bulk insert and the class
+    counters and RECEIVED_SMEAR events in the same transaction
+    returns ({smear id: images imported}, [(path, error)])
+    """
+    smears = {}
+    rows = []
+    pack_rows = []
+    failed = []
+    chunk = []
+    # smear id: checksums of the rows to insert
+    checksums = {}
+
+    def upload():
+        for smear_id in sorted({smear_id for _, smear_id, _ in chunk}):
+            added = checksums.setdefault(smear_id, set())
+
+            def stored(batch):
+                known, in_smear = CellImage.stored(smear_id, batch)
+                return known, in_smear | added.intersection(batch)
+
+            files = [(file, path) for file, file_smear_id, path in chunk if file_smear_id == smear_id]
+            pack = Pack() if app.config['SMEAR_PACK'] else None
+            uploaded, upload_failed = store_images([file for file, _ in files], stored=stored, pack=pack)
+            if pack and pack.key:
+                pack_rows.extend(PackEntry.rows(smear_id, pack))
+            fields = dict(uploaded)
+            for file, path in files:
+                if file.filename in fields:
+                    rows.append(dict(fields[file.filename], smear_id=smear_id, nucleated_cell_class=cell_class(path)))
+                    added.add(fields[file.filename]['checksum'])
+            failed.extend(upload_failed)
+        del chunk[:]
+
+    for path, data in images:
+        if smear is not None:
+            smear_id = smear.id
+        else:
+            folder = path.split('/')[0]
+            if folder not in smears:
+                sample = Sample.query.get(int(folder)) if folder.isdigit() else None
+                smears[folder] = sample.smears.first() if sample else None
+            if smears[folder] is None:
+                failed.append((path, 'No smear for sample {}'.format(folder)))
+                continue
+            if smears[folder].parent_sample.status:
+                failed.append((path, 'Sample {} was already validated'.format(folder)))
+                continue
+            smear_id = smears[folder].id
+        # the export path names the file, it is unique within the chunk
+        chunk.append((FileStorage(io.BytesIO(data), filename=path,
+                                  content_type=mimetypes.guess_type(path)[0] or 'application/octet-stream'),
+                      smear_id, path))
+        if len(chunk) >= app.config['INGEST_CHUNK']:
+            upload()
+    if chunk:
+        upload()
+    imported = Tally(row['smear_id'] for row in rows)
+    if rows:
+        db.session.execute(CellImage.__table__.insert().values(rows))
+        PackEntry.store(pack_rows)
+        # counters of smears holding images from before they existed are built first, without these rows
+        SmearClassCount.apply(Tally((row['smear_id'], row['nucleated_cell_class']) for row in rows))
+        for smear_id in imported:
+            db.session.add(Event(order_id=Smear.query.get(smear_id).parent_sample.order_id, user_id=user_id,
+                                 event_detail=OrderEventType.RECEIVED_SMEAR))
+        db.session.commit()
+        for smear_id in imported:
+            sprites.build_async(app, smear_id)
+    return dict(imported), failed
@@ -0,0 +1,215 @@
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from . import db
+from .cellavision import import_archive, import_images, iter_directory
+from .models import Order, Smear
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tgz', '.tar.gz')
+
+
+class HotFolder:
+    """
+    Watch directories where instruments write exports and import them
+    An export is a folder or a zip/tar archive whose name holds the order
+    accession, matched by HOTFOLDER_ACCESSION. It is complete when it holds
+    the HOTFOLDER_MARKER file (archive: a sibling file named archive + marker),
+    or when its size and modification time did not change for
+    HOTFOLDER_STABLE_SECONDS. Imported exports are recorded in the
+    checkpoint file so a restarted watcher skips them
+    """
+
+    def __init__(self, app, directories, user_id, checkpoint):
+        self.app = app
+        self.directories = directories
+        self.user_id = user_id
+        self.checkpoint = checkpoint
+        self.accession = re.compile(app.config['HOTFOLDER_ACCESSION'])
+        self.marker = app.config['HOTFOLDER_MARKER']
+        self.stable = app.config['HOTFOLDER_STABLE_SECONDS']
+        self.pool = ThreadPoolExecutor(max_workers=app.config['HOTFOLDER_WORKERS'])
+        self.lock = Lock()
+        self.done = self.load()
+        # path: (signature, time the signature was first seen)
+        self.seen = {}
+        # path: signature of the export when its import failed, retried once it changes
+        self.errors = {}
+        # exports without an open smear, checked again on every poll
+        self.waiting = set()
+        # exports whose name holds no order id, logged once
+        self.unnamed = set()
+        self.running = {}
+
+    def load(self):
+        """
+        Imported exports of the checkpoint file
+        """
+        if not os.path.exists(self.checkpoint):
+            return {}
+        with open(self.checkpoint) as f:
+            return json.load(f)
+
+    def save(self):
+        """
+        Write the checkpoint file atomically, caller must hold the lock
+        """
+        temp = self.checkpoint + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.done, f, indent=1, sort_keys=True)
+        os.replace(temp, self.checkpoint)
+
+    def exports(self):
+        """
+        Paths of the export folders and archives of the watched directories
+        """
+        for directory in self.directories:
+            for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+                if entry.name.startswith('.') or entry.name.endswith(self.marker):
+                    continue
+                if entry.is_dir() or entry.name.lower().endswith(ARCHIVE_EXTENSIONS):
+                    yield os.path.abspath(entry.path)
+
+    @staticmethod
+    def signature(path):
+        """
+        (number of files, total size, last modification) of an export
+        """
+        if not os.path.isdir(path):
+            stat = os.stat(path)
+            return [1, stat.st_size, stat.st_mtime]
+        count, size, mtime = 0, 0, os.stat(path).st_mtime
+        for root, _, files in os.walk(path):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                count += 1
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime)
+        return [count, size, mtime]
+
+    def is_complete(self, path, signature, now):
+        """
+        Check the marker file, or that the signature is stable
+        """
+        marker = os.path.join(path, self.marker) if os.path.isdir(path) else path + self.marker
+        if os.path.exists(marker):
+            return True
+        seen = self.seen.get(path)
+        if seen is None or seen[0] != signature:
+            self.seen[path] = (signature, now)
+            return False
+        return now - seen[1] >= self.stable
+
+    def order_id(self, path):
+        """
+        Order id named by the export, None if its name does not match HOTFOLDER_ACCESSION
+        """
+        match = self.accession.search(os.path.basename(path))
+        try:
+            return int(match.group(1)) if match else None
+        except (IndexError, ValueError):
+            return None
+
+    def smear_of(self, order_id):
+        """
+        Smear of an order, None if the order has no sample yet
+        or the sample was already validated
+        """
+        order = Order.query.get(order_id)
+        sample = order.samples.first() if order else None
+        if sample is None or sample.status:
+            return None
+        return sample.smears.first()
+
+    def poll(self):
+        """
+        Submit every complete export that was not imported yet
+        """
+        now = time.time()
+        for path, future in list(self.running.items()):
+            if future.done():
+                del self.running[path]
+        for path in self.exports():
+            if path in self.done or path in self.running:
+                continue
+            try:
+                signature = self.signature(path)
+            except OSError:
+                # export removed or renamed while it was read
+                continue
+            if self.errors.get(path) == signature or not self.is_complete(path, signature, now):
+                continue
+            order_id = self.order_id(path)
+            if order_id is None:
+                if path not in self.unnamed:
+                    self.app.logger.warning('No order id in the name of export %s', path)
+                    self.unnamed.add(path)
+                continue
+            smear = self.smear_of(order_id)
+            if smear is None:
+                if path not in self.waiting:
+                    self.app.logger.warning('No open smear for export %s', path)
+                    self.waiting.add(path)
+                continue
+            self.waiting.discard(path)
+            self.running[path] = self.pool.submit(self.ingest, path, signature, smear.id)
+        db.session.rollback()
+
+    def ingest(self, path, signature, smear_id):
+        """
+        Import one export into a smear, runs in the worker pool
+        """
+        start = time.time()
+        with self.app.app_context():
+            try:
+                smear = Smear.query.get(smear_id)
+                if os.path.isdir(path):
+                    imported, failed = import_images(self.app, iter_directory(path), self.user_id, smear)
+                else:
+                    with open(path, 'rb') as f:
+                        imported, failed = import_archive(self.app, f, self.user_id, smear)
+            except Exception:
+                self.app.logger.exception('Failed to import export %s', path)
+                self.errors[path] = signature
+                return
+            finally:
+                db.session.remove()
+        self.app.logger.info('Imported %s into smear %s: %s images, %s failed in %.1f s', path, smear_id,
+                             imported.get(smear_id, 0), len(failed), time.time() - start)
+        with self.lock:
+            self.done[path] = {'smear_id': smear_id, 'images': imported.get(smear_id, 0),
+                               'failed': [name for name, _ in failed], 'signature': signature,
+                               'imported_ts': time.strftime('%Y-%m-%dT%H:%M:%S')}
+            self.save()
+
+    def run(self, interval, once=False):
+        """
+        Poll the directories every interval seconds
+        :once: poll twice, HOTFOLDER_STABLE_SECONDS apart so stable exports
+               are detected, wait for the imports and return
+        """
+        try:
+            self.safe_poll()
+            if once:
+                time.sleep(self.stable)
+                self.safe_poll()
+                return
+            while True:
+                time.sleep(interval)
+                self.safe_poll()
+        finally:
+            self.pool.shutdown(wait=True)
+
+    def safe_poll(self):
+        """
+        Poll, logging errors instead of stopping the watcher,
+        eg- the database restarting. The next poll retries
+        """
+        try:
+            self.poll()
+        except Exception:
+            self.app.logger.exception('Failed to poll the export directories')
+            db.session.rollback()
+            db.session.remove()
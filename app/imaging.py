@@ -0,0 +1,71 @@
+import io
+from PIL import Image
+
+# content type and file extension of each output format
+FORMATS = {'JPEG': ('image/jpeg', '.jpg'), 'WEBP': ('image/webp', '.webp')}
+
+
+def transcode(data, variants, image_format='JPEG', quality=85):
+    """
+    Resize one image to every variant, runs in the image process pool
+    JPEG variants are progressive, WEBP variants are lossy
+    :data: bytes of the original image
+    :variants: list of (variant name, (max width, max height))
+    returns ((original width, original height), [(variant name, bytes, width, height)])
+    """
+    original = Image.open(io.BytesIO(data))
+    original.load()
+    size = original.size
+    if image_format == 'JPEG' and original.mode != 'RGB':
+        original = original.convert('RGB')
+    results = []
+    for name, max_size in variants:
+        pic = original.copy()
+        pic.thumbnail(max_size, Image.LANCZOS)
+        buffer = io.BytesIO()
+        if image_format == 'JPEG':
+            pic.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+        else:
+            pic.save(buffer, image_format, quality=quality)
+        results.append((name, buffer.getvalue(), pic.size[0], pic.size[1]))
+    return size, results
+
+
+def pack(images, max_size, cell_size, image_format='JPEG', quality=85):
+    """
+    Pack thumbnails into atlases of at most max_size x max_size pixels,
+    left to right on shelves as high as their tallest thumbnail.
+    Runs in the image process pool
+    :images: list of (image id, bytes) in grid order
+    :cell_size: (max width, max height) of a thumbnail, larger images are resized
+    returns ([(atlas bytes, width, height)], {image id: (atlas, x, y, width, height)})
+    """
+    layouts = [[]]
+    cells = {}
+    x = y = shelf = 0
+    for image_id, data in images:
+        pic = Image.open(io.BytesIO(data))
+        pic.thumbnail(cell_size, Image.LANCZOS)
+        width, height = pic.size
+        if x + width > max_size:
+            x, y, shelf = 0, y + shelf, 0
+        if y + height > max_size and layouts[-1]:
+            layouts.append([])
+            x = y = shelf = 0
+        layouts[-1].append((pic, x, y))
+        cells[image_id] = (len(layouts) - 1, x, y, width, height)
+        x += width
+        shelf = max(shelf, height)
+    atlases = []
+    for layout in filter(None, layouts):
+        size = (max(x + pic.size[0] for pic, x, _ in layout), max(y + pic.size[1] for pic, _, y in layout))
+        atlas = Image.new('RGB', size, (255, 255, 255))
+        for pic, x, y in layout:
+            atlas.paste(pic.convert('RGB'), (x, y))
+        buffer = io.BytesIO()
+        if image_format == 'JPEG':
+            atlas.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+        else:
+            atlas.save(buffer, image_format, quality=quality)
+        atlases.append((buffer.getvalue(), size[0], size[1]))
+    return atlases, cells
@@ -0,0 +1,103 @@
+import mimetypes
+import os
+import secrets
+import shutil
+import time
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+from . import db, sprites
+from .models import IngestJob, CellImage, Event, PackEntry
+from .utils import store_images, IngestStatus, OrderEventType, DUPLICATE_IMAGE, Pack
+
+
+def stage_images(app, smear, user_id, files):
+    """
+    Save uploaded images of a smear to the staging directory
+    and queue an ingest job, nothing is written to storage
+    File names are prefixed with their position to keep the upload order
+    """
+    staging = os.path.join(app.config['INGEST_STAGING_DIR'], '{}-{}'.format(smear.id, secrets.token_hex(4)))
+    os.makedirs(staging)
+    total = 0
+    for file in files:
+        if not file.filename:
+            continue
+        file.save(os.path.join(staging, '{:05d}_{}'.format(total, secure_filename(file.filename) or 'image')))
+        total += 1
+    job = IngestJob(smear_id=smear.id, user_id=user_id, staging=staging, total=total)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def process(app, job):
+    """
+    Upload the staged images of a job chunk by chunk
+    Each chunk commits its CellImage rows with the job progress, with
+    SMEAR_PACK a chunk is stored as one pack. A job taken
+    over after a crash skips the images already counted as done or failed.
+    Images already in the smear count as failed duplicates.
+    RECEIVED_SMEAR is logged, the staging directory removed and
+    the sprite of the smear built at the end
+    """
+    def stored(checksums):
+        return CellImage.stored(job.smear_id, checksums)
+
+    names = sorted(os.listdir(job.staging))
+    chunk = app.config['INGEST_CHUNK']
+    for start in range(job.done + job.failed, len(names), chunk):
+        paths = [os.path.join(job.staging, name) for name in names[start:start + chunk]]
+        files = [FileStorage(open(path, 'rb'), filename=os.path.basename(path)[6:],
+                             content_type=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+                 for path in paths]
+        try:
+            pack = Pack() if app.config['SMEAR_PACK'] else None
+            uploaded, failed = store_images(files, stored=stored, pack=pack)
+        finally:
+            for file in files:
+                file.close()
+        if not uploaded and any(not error.startswith(DUPLICATE_IMAGE) for _, error in failed):
+            # nothing of the chunk went through, most likely storage is unreachable
+            raise RuntimeError('Failed to upload {} images: {}'.format(len(failed), failed[0][1]))
+        if pack and pack.key:
+            PackEntry.store(PackEntry.rows(job.smear_id, pack))
+        db.session.add_all([CellImage(smear_id=job.smear_id, **fields) for _, fields in uploaded])
+        job.done += len(uploaded)
+        job.failed += len(failed)
+        if failed:
+            job.error = '\n'.join(filter(None, [job.error] + ['{}: {}'.format(name, error) for name, error in failed]))
+        db.session.commit()
+    db.session.add(Event(order_id=job.smear.parent_sample.order_id, user_id=job.user_id,
+                         event_detail=OrderEventType.RECEIVED_SMEAR))
+    job.status = IngestStatus.DONE
+    db.session.commit()
+    shutil.rmtree(job.staging, ignore_errors=True)
+    sprites.build_async(app, job.smear_id)
+
+
+def run(app, once=False):
+    """
+    Ingest worker loop, process jobs one at a time
+    A failed job is queued again until INGEST_MAX_ATTEMPTS
+    :once: return when no job is waiting
+    """
+    while True:
+        job = IngestJob.claim(app.config['INGEST_STALE_AFTER'])
+        if job is None:
+            if once:
+                return
+            time.sleep(app.config['INGEST_POLL_INTERVAL'])
+            continue
+        job_id = job.id
+        try:
+            process(app, job)
+            app.logger.info('Ingest job %s done, %s images, %s failed', job_id, job.done, job.failed)
+        except Exception as e:
+            app.logger.exception('Ingest job %s failed', job_id)
+            db.session.rollback()
+            job = IngestJob.query.get(job_id)
+            job.error = str(e)
+            job.status = IngestStatus.FAILED if job.attempts >= app.config['INGEST_MAX_ATTEMPTS'] \
+                else IngestStatus.QUEUED
+            db.session.commit()
+            time.sleep(app.config['INGEST_POLL_INTERVAL'])
@@ -133,6 +133,7 @@ class CBDForm(FlaskForm):
     plt = IntegerField('Platelet', validators=[DataRequired()])
     instrument = SelectField('Instrument', validators=[DataRequired(), Length(1, 128)])
     images = FileField('Images', validators=[FileAllowed(['jpg'])])
+    archive = FileField('Smear Export', validators=[FileAllowed(['zip', 'tar', 'gz', 'tgz'])])
     submit = SubmitField('Add Sample')
 
     def __init__(self, *args, **kwargs):
@@ -1,17 +1,24 @@
 import bleach
 import pytz
 import tzlocal
-from flask import redirect, render_template, url_for, flash, request, jsonify
+from flask import redirect, render_template, url_for, flash, request, jsonify, Response, abort
 from flask_login import login_required, current_user
 from . import lab
 from .forms import ProcedureForm, PatientForm, ClinicForm, OrderForm, MorphForm, CBDForm,\
     ProviderForm, DiffForm, UpdateClinicForm
 from .. import db, database
+from ..stream import pending_hub
+from ..differential import BatchDifferential
+from ..ingest import stage_images
+from ..cellavision import import_archive
+from .. import sprites
+from ..storage import storage
+from ..resize import resize_cache
 from ..models import LabProcedure, Patient, Clinic, Order, CellImage, Morphology, BloodMorphology,\
-    PathReview, Event, Sample, Provider, Smear
+    PathReview, Event, Sample, Provider, Smear, Counter, SmearClassCount, IngestJob, PackEntry
 from ..utils import Privilege, privilege_required, admin_required, save_image, wbc_classification,\
-    wbc_trial, smear_path_review, ResultOption, OrderEventType, wbc_exclusion, diff_pickle, \
-    upload_file_to_s3
+    wbc_trial, smear_path_review, ResultOption, OrderEventType, wbc_exclusion, \
+    store_images, datatable_params, datatable_order, datatable_response, get_app, Pack
 
 # add procedure
 
@@ -28,7 +35,7 @@ def add_procedure():
     if form.validate_on_submit():
         procedure = LabProcedure(title=form.title.data,
                                  content=form.procedure_content.data,
-                                 author=current_user._get_current_object())
+                                 author_id=current_user.id)
         database.create(procedure)
         flash('Added procedure', 'success')
         return redirect(url_for('lab.all_procedures'))
@@ -248,10 +255,16 @@ def all_patients():
 def json_patients():
     """
     Route to retrive patient data as JSON
+    Filtering, sorting and paging are done in the database
+    using DataTables server-side processing parameters
     """
-    patients = Patient.query.all()
-    json_patients = jsonify({'data': [patient.to_json() for patient in patients]})
-    return json_patients
+    params = datatable_params(request.args)
+    total = Counter.get('patients')
+    query = Patient.search(params['search'])
+    filtered = query.count() if params['search'] else total
+    query = datatable_order(query, params['order'], Patient.datatable_columns(), Patient.id)
+    patients = query.offset(params['start']).limit(params['length']).all()
+    return datatable_response(params, total, filtered, [patient.to_json() for patient in patients])
 
 
 @lab.route('/patients/<int:id>/edit', methods=['GET', 'POST'])
@@ -333,13 +346,21 @@ def pending_orders():
 def json_orders(status):
     """
     Route to retrive orders data as JSON object
-    """
-    if status == 'pending':
-        orders = Order.query.filter(Order.samples == None)
+    One page of the order feed is loaded in a single query
+    using DataTables server-side processing parameters
+    """
+    params = datatable_params(request.args)
+    query = Order.feed_query(status)
+    # count without the event subqueries in the select list
+    total = query.with_entities(Order.id).count()
+    if params['search']:
+        query = Order.feed_search(query, params['search'])
+        filtered = query.with_entities(Order.id).count()
     else:
-        orders = Order.query.all()
-    json_orders = jsonify({'data': [order.to_json() for order in orders]})
-    return json_orders
+        filtered = total
+    query = datatable_order(query, params['order'], Order.feed_columns(), Order.id)
+    orders = query.offset(params['start']).limit(params['length']).all()
+    return datatable_response(params, total, filtered, [Order.feed_json(order) for order in orders])
 
 
 @lab.route('/orders/<int:id>/add_sample', methods=['GET', 'POST'])
@@ -367,17 +388,54 @@ def add_sample(id):
                       sample_id=sample.id)
         e1 = Event(order_id=order.id, user_id=current_user.id, event_detail=OrderEventType.RECEIVED_SAMPLE)
         database.create_all([e1, smear])
-        if form.images.data:
-            pay_load = []
-            for image in request.files.getlist('images'):
-                wbc_file = upload_file_to_s3(image)
-                pay_load.append(CellImage(smear_id=smear.id, img=wbc_file))
+        if form.images.data and get_app().config['INGEST_ASYNC']:
+            stage_images(get_app(), smear, current_user.id, request.files.getlist('images'))
+            flash('Images are being uploaded, progress is shown on the sample page', 'info')
+        elif form.images.data:
+            pack = Pack() if get_app().config['SMEAR_PACK'] else None
+            uploaded, failed = store_images(request.files.getlist('images'), pack=pack,
+                                            stored=lambda checksums: CellImage.stored(smear.id, checksums))
+            if pack and pack.key:
+                PackEntry.store(PackEntry.rows(smear.id, pack))
+            pay_load = [CellImage(smear_id=smear.id, **fields) for _, fields in uploaded]
             pay_load.append(Event(order_id=order.id, user_id=current_user.id, event_detail=OrderEventType.RECEIVED_SMEAR))
             database.create_all(pay_load)
+            sprites.build_async(get_app(), smear.id)
+            if failed:
+                flash('{} of {} images failed to upload: {}'.format(
+                    len(failed), len(failed) + len(uploaded), ', '.join(name for name, _ in failed)), 'danger')
+        if form.archive.data:
+            imported, failed = import_archive(get_app(), form.archive.data.stream, current_user.id, smear)
+            flash('{} images imported from the smear export'.format(imported.get(smear.id, 0)), 'info')
+            if failed:
+                flash('{} images failed to import: {}'.format(
+                    len(failed), ', '.join(path for path, _ in failed)), 'danger')
         return redirect(url_for('lab.sample', id=sample.id))
     return render_template('lab/samples/add_sample.html', form=form, order=order)
 
 
+@lab.route('/smears/import', methods=['POST'])
+@login_required
+@privilege_required(Privilege.CREATE)
+def import_smears():
+    """
+    Route to import a CellaVision export archive (zip or tar)
+    into the smear given by smear_id, or a batch export
+    with one folder per sample id when smear_id is missing
+    return JSON object of imported image counts per smear and failed images
+    """
+    archive = request.files.get('archive')
+    if archive is None:
+        abort(400)
+    smear = None
+    if request.form.get('smear_id'):
+        smear = Smear.query.get_or_404(int(request.form['smear_id']))
+        if smear.parent_sample.status:
+            return jsonify({'error': 'Sample was already validated'}), 409
+    imported, failed = import_archive(get_app(), archive.stream, current_user.id, smear)
+    return jsonify({'imported': imported, 'failed': failed})
+
+
 @lab.route('/samples/<int:id>')
 @login_required
 @privilege_required(Privilege.VIEW)
@@ -391,7 +449,75 @@ def sample(id):
     # e2 = e[0].event_ts
     local = tzlocal.get_localzone()
     events = {each.event_detail.name: {'ts': pytz.utc.localize(each.event_ts, is_dst=None).astimezone(local), 'tech': each.user_id} for each in e}
-    return render_template('lab/samples/sample.html', sample=sample, donor=donor, events=events)
+    smear = sample.smears.first()
+    ingest = smear.ingest_jobs.order_by(IngestJob.id.desc()).first() if smear else None
+    return render_template('lab/samples/sample.html', sample=sample, donor=donor, events=events, ingest=ingest)
+
+
+@lab.route('/smears/<int:id>/ingest')
+@login_required
+@privilege_required(Privilege.VIEW)
+def ingest_progress(id):
+    """
+    Route to get upload progress of the latest ingest job of a smear
+    """
+    job = IngestJob.query.filter_by(smear_id=id).order_by(IngestJob.id.desc()).first_or_404()
+    return jsonify(job.to_json())
+
+
+@lab.route('/smears/<int:id>/cells/<path:key>')
+@login_required
+@privilege_required(Privilege.VIEW)
+def smear_cell(id, key):
+    """
+    Route to serve one image of a packed smear with a range read of its pack,
+    images of other uploads are sent by the storage backend
+    Image keys are derived from their content, responses are cached for long
+    """
+    entry = PackEntry.query.get((id, key))
+    if entry is None:
+        return storage.send(key)
+    response = Response(mimetype=entry.content_type)
+    response.set_etag(key)
+    response.cache_control.private = True
+    response.cache_control.max_age = 31536000
+    response = response.make_conditional(request)
+    if response.status_code != 304:
+        response.set_data(storage.read(entry.pack, entry.offset, entry.length))
+    return response
+
+
+@lab.route('/images/<int:id>/resized')
+@login_required
+@privilege_required(Privilege.VIEW)
+def resized_image(id):
+    """
+    Route to serve a cell image resized to fit ?w= and ?h=,
+    with quality ?q= and format ?fmt=jpeg|webp
+    eg- /lab/images/12/resized?w=128&q=60&fmt=webp
+    """
+    image = CellImage.query.get_or_404(id)
+    try:
+        params = resize_cache.params(get_app(), request.args)
+    except ValueError as e:
+        abort(400, str(e))
+    return resize_cache.send(get_app(), request, image, *params)
+
+
+@lab.route('/smears/<int:id>/sprite')
+@login_required
+@privilege_required(Privilege.VIEW)
+def smear_sprite(id):
+    """
+    Route to get the atlas manifest of the diff grid of a smear,
+    atlases carry their URL
+    """
+    smear = Smear.query.options(db.undefer(Smear.sprite)).get_or_404(id)
+    if smear.sprite is None:
+        abort(404)
+    atlases = smear.sprite['atlases']
+    urls = storage.sign([atlas['key'] for atlas in atlases])
+    return jsonify(dict(smear.sprite, atlases=[dict(atlas, url=urls[atlas['key']]) for atlas in atlases]))
 
 
 @lab.route('/smears/<int:id>')
@@ -404,8 +530,11 @@ def smear_images(id):
     uploaded to db.
     """
     smear = Smear.query.get_or_404(id)
-    return render_template('lab/samples/images.html', smear=smear, donor=smear.parent_sample.order.donor,
-                           sample=smear.parent_sample)
+    images = smear.images.all()
+    if not smear.packed:
+        storage.sign([image.variant('medium')[0] for image in images])
+    return render_template('lab/samples/images.html', smear=smear, images=images,
+                           donor=smear.parent_sample.order.donor, sample=smear.parent_sample)
 
 
 @lab.route('/smears/<int:id>/diff', methods=['GET', 'POST'])
@@ -415,7 +544,7 @@ def sample_diff(id):
     """
     Route to perform the differential on blood cells
     """
-    smear = Smear.query.get_or_404(id)
+    smear = Smear.query.options(db.undefer(Smear.sprite)).get_or_404(id)
     sample = smear.parent_sample
     classification = wbc_classification()
     morph = Morphology.query.order_by(Morphology.morph_name.asc()).all()
@@ -428,13 +557,12 @@ def sample_diff(id):
         if sample.status:
             flash('Sample was already validated', 'danger')
         else:
-            cell_tuple = smear.images.with_entities(CellImage.nucleated_cell_class,
-                                                    db.func.count(CellImage.id)).group_by(CellImage.nucleated_cell_class).all()
+            cell_tuple = SmearClassCount.tuples(smear.id)
             morph_list = [each.morphs.morph_name for each in smear.morphologies]
-            get_diff_pickle = diff_pickle(sample.wbc, cell_tuple)
+            get_diff_pickle = BatchDifferential.from_tuples([cell_tuple], [sample.wbc]).report(0)
             get_diff_pickle['morph'] = morph_list
             # update sample db
-            sample.diff_report = get_diff_pickle
+            sample.store_diff(get_diff_pickle)
             sample.status = True
             e = Event(order_id=sample.order.id, user_id=current_user.id, event_detail=OrderEventType.SMEAR_ANALYZED)
             if smear_path_review() in morph_list:
@@ -445,8 +573,17 @@ def sample_diff(id):
                 database.create_all([sample, e])
             flash('Diff is completed.' 'success')
         return redirect(url_for('lab.sample', id=sample.id))
+    cell_groups = smear.image_groups(classification)
+    sprite = sprites.manifest(get_app(), smear, [cell[0] for _, cells in cell_groups for cell in cells])
+    # sign the URLs of the grid in one batch, the template reads them from the cache
+    keys = [atlas['key'] for atlas in sprite['atlases']] if sprite else []
+    if not smear.packed:
+        keys.extend(cell[1] for _, cells in cell_groups for cell in cells
+                    if not sprite or str(cell[0]) not in sprite['cells'])
+    storage.sign(keys)
     return render_template('lab/samples/diff.html', smear=smear, include=include,
-                           classification=classification, wbc=wbc, checked=checked,
+                           classification=classification, cell_groups=cell_groups, sprite=sprite,
+                           wbc=wbc, checked=checked,
                            trial=wbc_trial(), donor=smear.parent_sample.order.donor, sample=sample,
                            review=smear_path_review(), pathrv=pathrv_status, form=form)
 
@@ -457,17 +594,65 @@ def sample_diff(id):
 def sample_temp_diff():
     """
     Route to change blood cell classification
+    The smear version is bumped like classify_cells so pages
+    holding the former version get 409 on their next batch
     """
-    cell_id = request.args.get("id")
+    cell_id = request.args.get("id", type=int)
     cell_class = request.args.get("box")
     class_list = wbc_classification()
-    i = class_list.index(cell_class)
-    if cell_class in class_list:
-        img = CellImage.query.filter_by(id=cell_id).first()
-        img.nucleated_cell_class = class_list.index(cell_class)
-        database.commit()
-        return str(i)
-    return None
+    if cell_class not in class_list:
+        abort(400)
+    img = CellImage.query.get_or_404(cell_id)
+    if img.smear.parent_sample.status:
+        abort(409)
+    db.session.execute(Smear.__table__.update().where(Smear.id == img.smear_id).values(version=Smear.version + 1))
+    img.nucleated_cell_class = class_list.index(cell_class)
+    database.commit()
+    return str(img.nucleated_cell_class)
+
+
+@lab.route('/smears/<int:id>/classify', methods=['POST'])
+@login_required
+@privilege_required(Privilege.UPDATE)
+def classify_cells(id):
+    """
+    Route to apply a batch of blood cell classification changes
+    expects JSON {'version': smear version, 'changes': [[image id, class name], ...]}
+    returns the new smear version, or 409 when the smear was changed elsewhere
+    """
+    payload = request.get_json(force=True, silent=True) or {}
+    class_list = wbc_classification()
+    try:
+        version = int(payload['version'])
+        changes = {int(image_id): class_list.index(cell_class) for image_id, cell_class in payload['changes']}
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    smear = Smear.query.get_or_404(id)
+    if smear.parent_sample.status:
+        return jsonify({'error': 'Sample was already validated', 'version': smear.version}), 409
+    result = Smear.classify_images(smear.id, version, changes)
+    if result is None:
+        return jsonify({'error': 'Smear was changed elsewhere', 'version': Smear.query.get(id).version}), 409
+    return jsonify({'version': result[0], 'updated': result[1]})
+
+
+@lab.route('/smears/<int:id>/diff/live')
+@login_required
+@privilege_required(Privilege.VIEW)
+def live_diff(id):
+    """
+    Route to return the in-progress differential of a smear
+    computed from the per-class counters, return JSON object
+    """
+    smear = Smear.query.get_or_404(id)
+    counts = SmearClassCount.tuples(smear.id)
+    class_list = wbc_classification()
+    report = BatchDifferential.from_tuples([counts], [smear.parent_sample.wbc]).report(0)
+    report['counts'] = {class_list[cell_class]: cells for cell_class, cells in counts}
+    report['version'] = smear.version
+    # keep the counters built on a first view
+    database.commit()
+    return jsonify(report)
 
 
 @lab.route('/samples/morph_value', methods=['GET'])
@@ -499,7 +684,9 @@ def sample_temp_morph():
             # db.session.add(smear)
             database.update(smear)
             if morph.morph_name == smear_path_review():
-                PathReview.query.filter_by(sample_id=smear.parent_sample.id).delete()
+                # delete through the session so Counter sees the removed reviews
+                for review in PathReview.query.filter_by(sample_id=smear.parent_sample.id).all():
+                    db.session.delete(review)
                 database.commit()
         return 'already exists'
     return 'fail'
@@ -530,14 +717,9 @@ def sample_temp_review():
 def json_samples(status):
     """
     Route to extract sample data as JSON
+    One page of the worklist is loaded in a single query
     """
-
-    if status == 'pending':
-        samples = Sample.query.filter(Sample.status.is_(False))
-    else:
-        samples = Sample.query.all()
-    json_samples = jsonify({'data': [sample.to_json() for sample in samples]})
-    return json_samples
+    return json_worklist(Sample.worklist_query(status))
 
 
 @lab.route('/samples/all')
@@ -573,19 +755,56 @@ def pending():
     return jsonify([{'name': 'pending', 'data': [s, p]}])
 
 
+@lab.route('/json/pending/stream')
+@login_required
+@privilege_required(Privilege.VIEW)
+def pending_stream():
+    """
+    Route to push pending sample/review counts and new sample alerts
+    as Server-Sent Events, events are only sent when counts change
+    204 when streams are off or the worker serves the most streams it may,
+    the browser then polls lab.pending
+    """
+    app = get_app()
+    if not app.config['PENDING_STREAM']:
+        return Response(status=204)
+    subscriber = pending_hub.subscribe(app)
+    if subscriber is None:
+        return Response(status=204)
+    response = Response(pending_hub.stream(app, subscriber), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # the server closes the response even when the client left before the stream started
+    response.call_on_close(lambda: pending_hub.unsubscribe(subscriber))
+    return response
+
+
 @lab.route('/samples/reviews/json/<string:status>')
 @login_required
 @privilege_required(Privilege.UPDATE)
 def json_reviews(status):
     """
     Route to extract sample pathrv data as JSON
+    One page of the review worklist is loaded in a single query
+    """
+    return json_worklist(Sample.worklist_query(status, reviews=True))
+
+
+def json_worklist(query):
+    """
+    Page, filter and sort a sample worklist query
+    using DataTables server-side processing parameters
     """
-    if status == 'pending':
-        paths = PathReview.query.filter(PathReview.status.is_(False))
+    params = datatable_params(request.args)
+    # count without the event subqueries in the select list
+    total = query.with_entities(Sample.id).count()
+    if params['search']:
+        query = Sample.worklist_search(query, params['search'])
+        filtered = query.with_entities(Sample.id).count()
     else:
-        paths = PathReview.query.all()
-    json_samples = jsonify({'data': [sample.smear.to_json() for sample in paths]})
-    return json_samples
+        filtered = total
+    query = datatable_order(query, params['order'], Sample.worklist_columns(), Sample.id)
+    samples = query.offset(params['start']).limit(params['length']).all()
+    return datatable_response(params, total, filtered, [Sample.worklist_json(sample) for sample in samples])
 
 
 @lab.route('/reviews/all')
@@ -632,7 +851,7 @@ def add_morphology():
         morph = Morphology(cell_type=form.cell_type.data,
                            morph_name=form.morphology.data,
                            options={'option-' + str(k): ResultOption(k).name for k in form.options.data},
-                           author=current_user._get_current_object())
+                           author_id=current_user.id)
         database.create(morph)
         flash('Added morph', 'success')
         return redirect(url_for('lab.add_morphology'))
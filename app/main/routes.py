@@ -1,22 +1,24 @@
-from datetime import datetime
 from flask import render_template, redirect, request, url_for, flash
 from flask_login import login_user, current_user, logout_user, login_required
 from . import main
 from .forms import LoginForm, ChangePasswordForm
 from .. import database
-from ..models import User, Sample, Patient, Clinic
-from ..utils import send_email
+from ..cache import user_cache
+from ..presence import visit_tracker
+from ..models import User, Counter
+from ..storage import storage
+from ..utils import send_email, get_app
 
 
 @main.before_app_request
 def before_request():
     """
     When user is logged in, record/update user visit//
+    visits are buffered in memory and written in batches
     Redirects url if the user account is not activated
     """
     if current_user.is_authenticated:
-        current_user.last_visit = datetime.utcnow()
-        database.commit()
+        visit_tracker.touch(get_app(), current_user.id)
         if not current_user.account_confirmed and request.endpoint and request.blueprint != 'main' and request.endpoint != 'static':
             return redirect(url_for('main.unconfirmed'))
 
@@ -28,12 +30,10 @@ def index():
     if not current_user.account_confirmed:
         return redirect(url_for('main.unconfirmed'))
     else:
-        patients = Patient.query.count()
-        samples = Sample.query.count()
-        users = User.query.count()
-        clinics = Clinic.query.count()
-        return render_template('index.html', total_patients=patients,
-                               total_samples=samples, total_users=users, total_clinics=clinics)
+        totals = Counter.get_many('patients', 'samples', 'users', 'clinics')
+        return render_template('index.html', total_patients=totals['patients'],
+                               total_samples=totals['samples'], total_users=totals['users'],
+                               total_clinics=totals['clinics'])
 
 
 @main.route('/unconfirmed')
@@ -54,17 +54,17 @@ def confirm(token):
         flash('Your account was previously confirmed', 'info')
         return redirect(url_for('main.index'))
 
-    if current_user.verify_new_user_token(token):
+    user = current_user.model()
+    if user.verify_new_user_token(token):
         form = ChangePasswordForm()
         if request.method == 'GET':
             flash('Please change your password to confirm account', 'success')
 
         if form.validate_on_submit():
-            if current_user.verify_password(form.old_password.data):
-                current_user.password = form.password.data
-                database.update(current_user)
-                # db.session.add(current_user)
-                # db.session.commit()
+            if user.verify_password(form.old_password.data):
+                user.password = form.password.data
+                database.update(user)
+                user_cache.invalidate(user.id)
                 flash('Your account is activated and password has been updated.', 'success')
                 return redirect(url_for('main.index'))
             else:
@@ -83,7 +83,7 @@ def not_confirmed():
     Route to send new confirmation email to user
     """
     if not current_user.account_confirmed:
-        token = current_user.get_new_user_token()
+        token = current_user.model().get_new_user_token()
         send_email(current_user.email,
                    'Confirm Your Account',
                    'users/email/confirm',
@@ -123,3 +123,13 @@ def logout():
     """
     logout_user()
     return redirect(url_for('main.index'))
+
+
+@main.route('/storage/<path:key>')
+@login_required
+def storage_file(key):
+    """
+    Handle requests to url route /storage/<key>
+    Serve a stored image, used by the local storage backend
+    """
+    return storage.send(key)
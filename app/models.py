@@ -1,14 +1,19 @@
 import os
 import bleach
-from datetime import datetime
+from collections import Counter as Tally, namedtuple
+from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from flask import current_app
+from flask import current_app, url_for
 from flask_login import UserMixin
 from markdown import markdown
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert, ARRAY, JSONB
 from . import db, login_manager
+from .cache import user_cache
+from .storage import storage
 from .utils import Privilege, define_roles, calculate_age, Gender, FluidType,\
-    OrderName, CellType, ProviderDegree, OrderEventType, InstrumentType
+    OrderName, CellType, ProviderDegree, OrderEventType, InstrumentType, datatable_search,\
+    wbc_classification, IngestStatus
 
 
 class User(UserMixin, db.Model):
@@ -139,9 +144,52 @@ class User(UserMixin, db.Model):
         return self.can(Privilege.ADMIN)
 
 
+class UserSnapshot(UserMixin, namedtuple('UserSnapshot', [
+        'id', 'username', 'user_first_name', 'user_last_name', 'email', 'title', 'profile_image',
+        'user_since', 'last_visit', 'account_confirmed', 'role_id', 'role_name', 'privileges'])):
+    """
+    Immutable copy of a user and its role privileges,
+    cached per worker and used as Flask-Login current_user
+    Routes that change the user load the row with model()
+    """
+
+    @staticmethod
+    def load(user_id):
+        """
+        Load user and role privileges in one query
+        """
+        row = db.session.query(User, Role.name, Role.privileges)\
+            .outerjoin(Role, User.role_id == Role.id)\
+            .filter(User.id == user_id).first()
+        if row is None:
+            return None
+        user, role_name, privileges = row
+        return UserSnapshot(user.id, user.username, user.user_first_name, user.user_last_name,
+                            user.email, user.title, user.profile_image, user.user_since,
+                            user.last_visit, user.account_confirmed, user.role_id, role_name, privileges)
+
+    def model(self):
+        """
+        Full User row of this snapshot
+        """
+        return User.query.get(self.id)
+
+    def can(self, perm):
+        """
+        Verify if user can perform cetrain functions
+        """
+        return self.privileges is not None and self.privileges & perm == perm
+
+    def is_administrator(self):
+        """
+        Verify if the user has administration privilege
+        """
+        return self.can(Privilege.ADMIN)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    return user_cache.get(int(user_id), UserSnapshot.load)
 
 
 class Role(db.Model):
@@ -180,6 +228,7 @@ class Role(db.Model):
             role.default = (role.name == default_role)
             db.session.add(role)
         db.session.commit()
+        user_cache.clear()
 
     def add_privilege(self, perm):
         """
@@ -313,6 +362,29 @@ class Patient(db.Model):
         """
         return calculate_age(self.birth_date)
 
+    @staticmethod
+    def datatable_columns():
+        """
+        Sortable columns for the patient DataTable,
+        age is computed from birth_date in the database
+        """
+        return {'id': Patient.id,
+                'full_name': Patient.pat_first_name,
+                'dob': Patient.birth_date,
+                'age': db.func.age(Patient.birth_date),
+                'gender': Patient.gender,
+                'registered': Patient.update_ts}
+
+    @staticmethod
+    def search(term):
+        """
+        Patient query filtered by search term,
+        every word has to match patient id or one of the names
+        """
+        return datatable_search(Patient.query, term,
+                                [Patient.pat_first_name, Patient.pat_middle_name, Patient.pat_last_name],
+                                Patient.id)
+
     def to_json(self):
         """
         Patient data in dictionary format to dump as JSON data
@@ -343,8 +415,8 @@ class Order(db.Model):
     order_fluid_type = db.Column(db.Enum(FluidType, name="type"))
     order_name = db.Column(db.Enum(OrderName, name="req"))
     order_comment = db.Column(db.String())
-    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False)
-    order_loc_id = db.Column(db.Integer, db.ForeignKey('clinics.id'), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False, index=True)
+    order_loc_id = db.Column(db.Integer, db.ForeignKey('clinics.id'), nullable=False, index=True)
     order_provider = db.Column(db.Integer, db.ForeignKey("providers.id"), nullable=False)
     samples = db.relationship('Sample', backref='order', lazy='dynamic')
     events = db.relationship('Event', backref='order', lazy='dynamic')
@@ -377,6 +449,71 @@ class Order(db.Model):
         }
         return json_order
 
+    @staticmethod
+    def feed_query(status='all'):
+        """
+        Order feed projection as a single query
+        Patient, provider, clinic and sample id are joined and
+        events are aggregated per order by correlated subqueries,
+        which only run for the rows of the requested page
+        """
+        event_names, event_ts = Event.order_aggregates()
+        query = db.session.query(Order.id, Order.order_fluid_type, Order.order_name,
+                                 Patient.pat_first_name, Patient.pat_middle_name, Patient.pat_last_name,
+                                 Provider.pro_first_name, Provider.pro_last_name, Provider.degree,
+                                 Clinic.clinic_code_name, Sample.id.label('sample_id'),
+                                 event_names, event_ts)\
+            .join(Patient, Order.patient_id == Patient.id)\
+            .join(Provider, Order.order_provider == Provider.id)\
+            .join(Clinic, Order.order_loc_id == Clinic.id)\
+            .outerjoin(Sample, Sample.order_id == Order.id)
+        if status == 'pending':
+            query = query.filter(Sample.id.is_(None))
+        return query
+
+    @staticmethod
+    def feed_search(query, term):
+        """
+        Filter the order feed by patient, provider, clinic or order id
+        """
+        return datatable_search(query, term,
+                                [Patient.pat_first_name, Patient.pat_middle_name, Patient.pat_last_name,
+                                 Provider.pro_first_name, Provider.pro_last_name, Clinic.clinic_code_name],
+                                Order.id)
+
+    @staticmethod
+    def feed_columns():
+        """
+        Sortable columns for the order DataTable
+        Orders are created together with their CREATED event,
+        so order id keeps the creation order without touching events
+        """
+        return {'id': Order.id,
+                'patient': Patient.pat_first_name,
+                'order_loc': Clinic.clinic_code_name,
+                'order_prov': Provider.pro_first_name,
+                'created': Order.id,
+                'order_name': Order.order_name,
+                'sample_type': Order.order_fluid_type}
+
+    @staticmethod
+    def feed_json(row):
+        """
+        Order feed row in the same format as Order.to_json
+        """
+        status = row.sample_id is not None
+        return {
+            'id': row.id,
+            'patient': row.pat_first_name + " " + row.pat_middle_name + " " + row.pat_last_name,
+            'sample_type': row.order_fluid_type.value,
+            'order_name': row.order_name.name,
+            'events': Event.aggregates_json(row),
+            'order_loc': row.clinic_code_name,
+            'order_prov': row.pro_first_name + " " + row.pro_last_name + ", " + row.degree.value,
+            'status': status,
+            'sample_id': row.sample_id
+        }
+
     def order_events_json(self):
         """
         Order Events data in dictionary format to dump as JSON data
@@ -396,6 +533,8 @@ class Event(db.Model):
     :event_detail: Detail of the event -eg Order Created, Sample received
     """
     __tablename__ = "events"
+    # covers the per order event aggregates, ordered by event id
+    __table_args__ = (db.Index('ix_events_order_id_id', 'order_id', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey("orders.id"), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -405,6 +544,27 @@ class Event(db.Model):
     def __repr__(self):
         return "Event : {} for order ID {}".format(self.event_detail, self.order_id)
 
+    @staticmethod
+    def order_aggregates():
+        """
+        Correlated subqueries that aggregate event names and timestamps
+        of the enclosing Order row, ordered by event id
+        """
+        event_names = db.session.query(
+            db.func.array_agg(aggregate_order_by(db.cast(Event.event_detail, db.Text), Event.id)))\
+            .filter(Event.order_id == Order.id).correlate(Order).as_scalar()
+        event_ts = db.session.query(
+            db.func.array_agg(aggregate_order_by(Event.event_ts, Event.id)))\
+            .filter(Event.order_id == Order.id).correlate(Order).as_scalar()
+        return event_names.label('event_names'), event_ts.label('event_ts')
+
+    @staticmethod
+    def aggregates_json(row):
+        """
+        Events of a row selected with order_aggregates as {event name: timestamp}
+        """
+        return dict(zip(row.event_names or [], row.event_ts or []))
+
 
 class Sample(db.Model):
     """
@@ -415,33 +575,144 @@ class Sample(db.Model):
     :hct: Hematocrit count taken from instrument
     :plt: Platelet count taken from instrument
     :status: boolean to capture if testing is complete or in progress
-    :diff_report: After all images are analyzed, results are stored as Binary Text
+    :diff_report: legacy pickled results, deferred, read only by the fallback of
+                  differential() and the backfill-diff command
+    :diff_total: number of WBC counted, set when the differential is validated
+    :diff_morph: names of WBC morphologies reported with the differential
     :pathrv: boolean to check if sample needs pathologists review
     """
     __tablename__ = 'samples'
+    # partial index of the pending worklist
+    __table_args__ = (db.Index('ix_samples_pending', 'id', postgresql_where=db.text('status IS false')),)
     id = db.Column(db.Integer, primary_key=True)
     wbc = db.Column(db.Float, nullable=False)
     rbc = db.Column(db.Float, nullable=False)
     hgb = db.Column(db.Float, nullable=False)
     hct = db.Column(db.Integer, nullable=False)
     plt = db.Column(db.Integer, nullable=False)
-    status = db.Column(db.Boolean, default=False)
-    diff_report = db.Column(db.PickleType)
+    # active history keeps the old status on change, used by Counter
+    status = db.column_property(db.Column(db.Boolean, default=False), active_history=True)
+    diff_report = db.deferred(db.Column(db.PickleType))
+    diff_total = db.Column(db.Integer)
+    diff_morph = db.Column(ARRAY(db.Text))
     pathrv = db.Column(db.Boolean, default=False)
     order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), unique=True, nullable=False)
     smears = db.relationship('Smear', backref='parent_sample', lazy='dynamic')
     path_reviews = db.relationship('PathReview', backref='smear', lazy='dynamic')
     comments = db.relationship('Comment', backref='sample', lazy='dynamic')
+    diff_results = db.relationship('DiffResult', backref='sample', order_by='DiffResult.seq',
+                                   cascade='all, delete-orphan')
 
     def __repr__(self):
         return "Sample ID: {}".format(self.id)
 
+    def store_diff(self, report):
+        """
+        Store a differential report as diff_results rows
+        :report: dictionary in the diff_pickle format with morph list
+        """
+        self.diff_total = report['total']
+        self.diff_morph = report.get('morph', [])
+        self.diff_results = [DiffResult(**row) for row in DiffResult.rows(report)]
+
+    def differential(self):
+        """
+        Validated differential in the diff_pickle format, built from diff_results
+        Samples validated before diff_results existed fall back to the
+        pickled report until backfill-diff converts them
+        """
+        if self.diff_total is None:
+            return self.diff_report
+        d = {}
+        if self.diff_total > 0:
+            d['wbc'] = []
+            for result in self.diff_results:
+                values = {'relative': result.relative, 'absolute': result.absolute}
+                if result.cell_class == 'nrbcs':
+                    d['nrbcs'] = values
+                else:
+                    d['wbc'].append((result.cell_class, dict(values, seq=result.seq)))
+        return {'diff': d, 'total': self.diff_total, 'morph': self.diff_morph or []}
+
     @staticmethod
     def get_pending_data():
         """
         Function to get current pending sample count
         """
-        return Sample.query.filter_by(status=False).count()
+        return Counter.get('pending_samples')
+
+    @staticmethod
+    def worklist_query(status='all', reviews=False):
+        """
+        Sample worklist projection as a single query
+        Order, patient, provider, clinic and pathologist review are joined
+        and order events are aggregated per row of the requested page
+        :reviews: only samples with a pathologist review, status filters the review
+        """
+        event_names, event_ts = Event.order_aggregates()
+        query = db.session.query(Sample.id, Sample.status, Sample.pathrv, Order.order_name,
+                                 Patient.pat_first_name, Patient.pat_middle_name, Patient.pat_last_name,
+                                 Provider.pro_first_name, Provider.pro_last_name, Provider.degree,
+                                 Clinic.clinic_code_name, PathReview.status.label('path_status'),
+                                 event_names, event_ts)\
+            .join(Order, Sample.order_id == Order.id)\
+            .join(Patient, Order.patient_id == Patient.id)\
+            .join(Provider, Order.order_provider == Provider.id)\
+            .join(Clinic, Order.order_loc_id == Clinic.id)
+        if reviews:
+            query = query.join(PathReview, PathReview.sample_id == Sample.id)
+            if status == 'pending':
+                query = query.filter(PathReview.status.is_(False))
+        else:
+            query = query.outerjoin(PathReview, PathReview.sample_id == Sample.id)
+            if status == 'pending':
+                query = query.filter(Sample.status.is_(False))
+        return query
+
+    @staticmethod
+    def worklist_search(query, term):
+        """
+        Filter the sample worklist by patient, provider, clinic or sample id
+        """
+        return datatable_search(query, term,
+                                [Patient.pat_first_name, Patient.pat_middle_name, Patient.pat_last_name,
+                                 Provider.pro_first_name, Provider.pro_last_name, Clinic.clinic_code_name],
+                                Sample.id)
+
+    @staticmethod
+    def worklist_columns():
+        """
+        Sortable columns for the sample and review DataTables
+        Samples are received when they are created,
+        so sample id keeps the received order
+        """
+        return {'id': Sample.id,
+                'patient': Patient.pat_first_name,
+                'test': Order.order_name,
+                'received': Sample.id,
+                'created': Order.id,
+                'provider': Provider.pro_first_name,
+                'status': Sample.status,
+                'path_status': PathReview.status,
+                'clinic': Clinic.clinic_code_name}
+
+    @staticmethod
+    def worklist_json(row):
+        """
+        Sample worklist row in the same format as Sample.to_json
+        """
+        json_sample = {
+            'id': row.id,
+            'patient': row.pat_first_name + " " + row.pat_middle_name + " " + row.pat_last_name,
+            'status': row.status,
+            'provider': row.pro_first_name + " " + row.pro_last_name + ", " + row.degree.value,
+            'clinic': row.clinic_code_name,
+            'events': Event.aggregates_json(row),
+            'test': row.order_name.name
+        }
+        if row.pathrv:
+            json_sample['path_status'] = row.path_status
+        return json_sample
 
     def to_json(self):
         """
@@ -465,39 +736,444 @@ class Sample(db.Model):
         return json_sample
 
 
+class DiffResult(db.Model):
+    """
+    Create a table diff_results
+    One row per reported cell class of a validated differential
+    :sample_id: sample id, primary key
+    :cell_class: name of Blood Cells, primary key
+    :seq: index number of Blood Cells, keeps the report order
+    :relative: percent of WBC counted
+    :absolute: relative count multiplied by WBC of the sample
+    """
+    __tablename__ = 'diff_results'
+    __table_args__ = (db.Index('ix_diff_results_class_relative', 'cell_class', 'relative'),)
+    sample_id = db.Column(db.Integer, db.ForeignKey('samples.id'), primary_key=True)
+    cell_class = db.Column(db.String(32), primary_key=True)
+    seq = db.Column(db.Integer, nullable=False)
+    relative = db.Column(db.Integer, nullable=False)
+    absolute = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return "Diff Result: {} {} {}%".format(self.sample_id, self.cell_class, self.relative)
+
+    @staticmethod
+    def rows(report, sample_id=None):
+        """
+        Rows of a report in the diff_pickle format
+        sample_id is added for bulk inserts
+        """
+        diff = report.get('diff') or {}
+        rows = [{'cell_class': cell_class, 'seq': values['seq'],
+                 'relative': values['relative'], 'absolute': values['absolute']}
+                for cell_class, values in diff.get('wbc', [])]
+        if 'nrbcs' in diff:
+            rows.append({'cell_class': 'nrbcs', 'seq': wbc_classification().index('nrbcs'),
+                         'relative': diff['nrbcs']['relative'], 'absolute': diff['nrbcs']['absolute']})
+        if sample_id is not None:
+            for row in rows:
+                row['sample_id'] = sample_id
+        return rows
+
+    @staticmethod
+    def samples_above(cell_class, relative):
+        """
+        Query of validated samples with more than relative percent of cell_class
+        eg- DiffResult.samples_above('blasts', 20)
+        """
+        return Sample.query.join(DiffResult, DiffResult.sample_id == Sample.id)\
+            .filter(DiffResult.cell_class == cell_class, DiffResult.relative > relative)
+
+
 class Smear(db.Model):
     """
     Create a table Smear
     Each sample will have a blood smear
     :instrument_type: instrument that will scan the slide - eg CELLAVISION
     :sample_id: each smear belongs to a sample
+    :version: classification version, guards concurrent edits of the diff
+    :sprite: manifest of the atlases of the diff grid thumbnails, see sprites.build
+             deferred, read by the diff page and the sprite route only
+    :packed: images of the smear were stored in packs, see PackEntry
     """
     __tablename__ = 'smears'
     id = db.Column(db.Integer, primary_key=True)
     instrument_type = db.Column(db.Enum(InstrumentType, name="instrument"))
-    sample_id = db.Column(db.Integer, db.ForeignKey('samples.id'), nullable=False)
+    sample_id = db.Column(db.Integer, db.ForeignKey('samples.id'), nullable=False, index=True)
+    # bumped on every batch of classification changes
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    sprite = db.deferred(db.Column(JSONB(none_as_null=True)))
+    packed = db.Column(db.Boolean, nullable=False, default=False, server_default='false')
     images = db.relationship('CellImage', backref='smear', lazy='dynamic')
+    pack_entries = db.relationship('PackEntry', backref='smear', lazy='dynamic')
+    ingest_jobs = db.relationship('IngestJob', backref='smear', lazy='dynamic')
     morphologies = db.relationship(
         'BloodMorphology', cascade='all, delete-orphan', backref='blood_smears')
 
     def __repr__(self):
         return "Smear: {} {}".format(self.id, self.sample_id)
 
+    def image_url(self, key):
+        """
+        URL of an image of the smear, images of packed smears
+        are served by range reads of their pack
+        """
+        if self.packed:
+            return url_for('lab.smear_cell', id=self.id, key=key)
+        return storage.url(key)
+
+    def image_groups(self, classification):
+        """
+        Images of the smear loaded in one query and bucketed by
+        nucleated_cell_class in one pass
+        Grid thumbnails are used, the original image when there is none
+        returns list of (class name, [(image id, img, width, height)]) in classification order
+        """
+        groups = [[] for _ in classification]
+        grid = CellImage.img_grid.isnot(None)
+        rows = db.session.query(CellImage.id, CellImage.nucleated_cell_class,
+                                db.func.coalesce(CellImage.img_grid, CellImage.img),
+                                db.case([(grid, CellImage.grid_width)], else_=CellImage.width),
+                                db.case([(grid, CellImage.grid_height)], else_=CellImage.height))\
+            .filter(CellImage.smear_id == self.id).order_by(CellImage.id)
+        for image_id, cell_class, img, width, height in rows:
+            if cell_class is None:
+                cell_class = 0
+            if 0 <= cell_class < len(groups):
+                groups[cell_class].append((image_id, img, width, height))
+        return list(zip(classification, groups))
+
+    @staticmethod
+    def classify_images(smear_id, version, changes):
+        """
+        Apply classification changes {image id: class index} of a smear
+        in one transaction, with a single UPDATE for all images
+        The smear version is bumped only if it still equals version,
+        otherwise nothing is written and None is returned
+        returns (new version, number of updated images)
+        """
+        bumped = db.session.execute(Smear.__table__.update()
+                                    .where(db.and_(Smear.id == smear_id, Smear.version == version))
+                                    .values(version=Smear.version + 1)).rowcount
+        if not bumped:
+            db.session.rollback()
+            return None
+        updated = 0
+        if changes:
+            # old classes are read under the smear row lock taken by the version bump
+            old_classes = db.session.query(CellImage.id, CellImage.nucleated_cell_class)\
+                .filter(CellImage.smear_id == smear_id, CellImage.id.in_(list(changes))).all()
+            deltas = Tally()
+            for image_id, cell_class in old_classes:
+                deltas[(smear_id, cell_class or 0)] -= 1
+                deltas[(smear_id, changes[image_id])] += 1
+            updated = db.session.execute(CellImage.__table__.update()
+                                         .where(db.and_(CellImage.smear_id == smear_id,
+                                                        CellImage.id.in_(list(changes))))
+                                         .values(nucleated_cell_class=db.case(changes, value=CellImage.id))).rowcount
+            SmearClassCount.apply(deltas)
+        db.session.commit()
+        return version + 1, updated
+
 
 class CellImage(db.Model):
     """
     Create a table images,
     each row represent a single image of White Blood Cells
-    :imag: image of a white blood cell
+    :imag: image of a white blood cell, the original upload
+    :img_grid: thumbnail shown in the differential grid
+    :img_medium: image shown for review
+    :width, height: pixel size of each image
+    :checksum: SHA-256 of the original, empty for images uploaded before content keys
     :nucleated_cell_class: index number of Blood Cells, default = 0 = unidentified cell
     """
     __tablename__ = 'images'
+    # covers image lookups of a smear and class counts of a smear,
+    # a smear holds each image once, stored images are found by checksum
+    __table_args__ = (db.Index('ix_images_smear_id_class', 'smear_id', 'nucleated_cell_class'),
+                      db.Index('ix_images_smear_id_checksum', 'smear_id', 'checksum', unique=True),
+                      db.Index('ix_images_checksum', 'checksum'))
     id = db.Column(db.Integer, primary_key=True)
     img = db.Column(db.String(64), nullable=False)
-    nucleated_cell_class = db.Column(db.Integer, default=0)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    # resized variants, empty for images uploaded before resizing
+    img_grid = db.Column(db.String(64))
+    grid_width = db.Column(db.Integer)
+    grid_height = db.Column(db.Integer)
+    img_medium = db.Column(db.String(64))
+    medium_width = db.Column(db.Integer)
+    medium_height = db.Column(db.Integer)
+    checksum = db.Column(db.String(64))
+    # active history keeps the old class on change, used by SmearClassCount
+    nucleated_cell_class = db.column_property(db.Column(db.Integer, default=0), active_history=True)
 
     smear_id = db.Column(db.Integer, db.ForeignKey('smears.id'), nullable=False)
 
+    def variant(self, name):
+        """
+        (key, width, height) of the grid or medium variant,
+        the original image when the variant was never made
+        """
+        key = getattr(self, 'img_' + name)
+        if key is None:
+            return self.img, self.width, self.height
+        return key, getattr(self, name + '_width'), getattr(self, name + '_height')
+
+    def read(self, key=None):
+        """
+        Bytes of the original image or of key, one of its variants,
+        by a range read of the pack of a packed smear
+        """
+        key = key or self.img
+        entry = PackEntry.query.get((self.smear_id, key)) if self.smear.packed else None
+        if entry is not None:
+            return storage.read(entry.pack, entry.offset, entry.length)
+        return storage.read(key)
+
+    @staticmethod
+    def stored(smear_id, checksums):
+        """
+        Images already stored with one of checksums, see store_images
+        Images of packed smears are stored only inside their packs, their
+        keys are never reused
+        returns ({checksum: CellImage fields} of smears not packed, set of checksums of the smear)
+        """
+        columns = ['img', 'width', 'height', 'img_grid', 'grid_width', 'grid_height',
+                   'img_medium', 'medium_width', 'medium_height', 'checksum']
+        known, in_smear = {}, set()
+        if not checksums:
+            return known, in_smear
+        rows = db.session.query(CellImage.smear_id, Smear.packed, *[getattr(CellImage, column) for column in columns]) \
+            .join(Smear, Smear.id == CellImage.smear_id)\
+            .filter(CellImage.checksum.in_(checksums))
+        for row in rows:
+            if row.smear_id == smear_id:
+                in_smear.add(row.checksum)
+            if not row.packed:
+                known[row.checksum] = {column: getattr(row, column) for column in columns}
+        return known, in_smear
+
+
+class PackEntry(db.Model):
+    """
+    Create a table pack_entries
+    Offset index of the images of a smear stored in packs,
+    one storage object holding the images of one upload
+    :key: image key of CellImage img or variant columns
+    :pack: storage key of the pack
+    :offset, length: bytes of the image within the pack
+    """
+    __tablename__ = 'pack_entries'
+    smear_id = db.Column(db.Integer, db.ForeignKey('smears.id'), primary_key=True)
+    key = db.Column(db.String(64), primary_key=True)
+    pack = db.Column(db.String(64), nullable=False)
+    offset = db.Column(db.BigInteger, nullable=False)
+    length = db.Column(db.Integer, nullable=False)
+    content_type = db.Column(db.String(32))
+
+    def __repr__(self):
+        return "Pack Entry: {} {} {}".format(self.smear_id, self.key, self.pack)
+
+    @staticmethod
+    def rows(smear_id, pack):
+        """
+        Rows of an uploaded Pack for bulk inserts
+        """
+        return [{'smear_id': smear_id, 'key': key, 'pack': pack.key, 'offset': offset,
+                 'length': length, 'content_type': content_type}
+                for key, (offset, length, content_type) in pack.entries.items()]
+
+    @staticmethod
+    def store(rows):
+        """
+        Insert pack entry rows and mark their smears as packed,
+        in the caller's transaction
+        """
+        if not rows:
+            return
+        db.session.execute(insert(PackEntry.__table__).values(rows).on_conflict_do_nothing())
+        db.session.execute(Smear.__table__.update()
+                           .where(Smear.id.in_({row['smear_id'] for row in rows}))
+                           .values(packed=True))
+
+
+class IngestJob(db.Model):
+    """
+    Create a table ingest_jobs
+    Images of a smear staged on local disk, uploaded by the ingest worker
+    :staging: directory of the staged images
+    :total: number of staged images
+    :done: number of images attached to the smear
+    :failed: number of images that could not be resized or uploaded
+    :attempts: number of times a worker started the job
+    :error: last error of the job and names of failed images
+    """
+    __tablename__ = 'ingest_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    smear_id = db.Column(db.Integer, db.ForeignKey('smears.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    status = db.Column(db.Enum(IngestStatus, name='ingest_status'), nullable=False, default=IngestStatus.QUEUED)
+    staging = db.Column(db.String(255), nullable=False)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_ts = db.Column(db.DateTime(), default=datetime.utcnow)
+    # also the heartbeat of the worker running the job
+    updated_ts = db.Column(db.DateTime(), default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return "Ingest Job: {} smear {} {}".format(self.id, self.smear_id, self.status.name)
+
+    @staticmethod
+    def claim(stale_after):
+        """
+        Take the oldest queued job, or a running job whose worker
+        stopped updating it for stale_after seconds
+        Concurrent workers skip the row locked by each other
+        """
+        stale = datetime.utcnow() - timedelta(seconds=stale_after)
+        job = IngestJob.query.filter(db.or_(IngestJob.status == IngestStatus.QUEUED,
+                                            db.and_(IngestJob.status == IngestStatus.RUNNING,
+                                                    IngestJob.updated_ts < stale)))\
+            .order_by(IngestJob.id).with_for_update(skip_locked=True).first()
+        if job is None:
+            db.session.rollback()
+            return None
+        job.status = IngestStatus.RUNNING
+        job.attempts += 1
+        db.session.commit()
+        return job
+
+    def to_json(self):
+        """
+        Progress of the job for the sample page
+        """
+        return {'status': self.status.name,
+                'total': self.total,
+                'done': self.done,
+                'failed': self.failed}
+
+
+class SmearClassCount(db.Model):
+    """
+    Create a table smear_class_counts
+    Number of images of a smear in each nucleated cell class,
+    updated in the same transaction as every classification change
+    :smear_id: smear id, primary key
+    :cell_class: index number of Blood Cells, primary key
+    :cells: number of images in the class
+    """
+    __tablename__ = 'smear_class_counts'
+    smear_id = db.Column(db.Integer, db.ForeignKey('smears.id'), primary_key=True)
+    cell_class = db.Column(db.Integer, primary_key=True)
+    cells = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "Smear Class Count: {} {} {}".format(self.smear_id, self.cell_class, self.cells)
+
+    @staticmethod
+    def apply(deltas):
+        """
+        Add {(smear id, class index): delta} to the counters with a single upsert
+        Deltas are already written to the images. Counters of smears that
+        have none are built first from the images without the deltas
+        """
+        rows = [{'smear_id': smear_id, 'cell_class': cell_class, 'cells': delta}
+                for (smear_id, cell_class), delta in deltas.items() if delta and smear_id is not None]
+        if not rows:
+            return
+        for smear_id in sorted({row['smear_id'] for row in rows}):
+            SmearClassCount.build(smear_id, {row['cell_class']: row['cells'] for row in rows
+                                             if row['smear_id'] == smear_id})
+        table = SmearClassCount.__table__
+        statement = insert(table).values(rows)
+        statement = statement.on_conflict_do_update(index_elements=[table.c.smear_id, table.c.cell_class],
+                                                    set_={'cells': table.c.cells + statement.excluded.cells})
+        db.session.execute(statement)
+
+    @staticmethod
+    def rebuild(smear_id=None):
+        """
+        Repair function, recompute counters of one or all smears from images
+        """
+        table = SmearClassCount.__table__
+        cell_class = db.func.coalesce(CellImage.nucleated_cell_class, 0)
+        counts = db.select([CellImage.smear_id, cell_class, db.func.count(CellImage.id)])\
+            .group_by(CellImage.smear_id, cell_class)
+        delete = table.delete()
+        if smear_id is not None:
+            counts = counts.where(CellImage.smear_id == smear_id)
+            delete = delete.where(table.c.smear_id == smear_id)
+        db.session.execute(delete)
+        db.session.execute(table.insert().from_select(['smear_id', 'cell_class', 'cells'], counts))
+        db.session.commit()
+
+    @staticmethod
+    def build(smear_id, written=None):
+        """
+        Count the images of a smear that has no counters yet, smears imported
+        before counters existed. Runs in the transaction of the caller, without
+        commit. A concurrent build of the same smear waits for the rows of the
+        first one and inserts nothing
+        :written: {class index: delta} already written to the images and not
+                  applied yet, left out of the count
+        """
+        table = SmearClassCount.__table__
+        cell_class = db.func.coalesce(CellImage.nucleated_cell_class, 0)
+        parts = [db.select([CellImage.smear_id.label('smear_id'), cell_class.label('cell_class'),
+                            db.func.count(CellImage.id).label('cells')])
+                 .where(CellImage.smear_id == smear_id).group_by(CellImage.smear_id, cell_class)]
+        parts.extend(db.select([db.literal(smear_id), db.literal(written_class), db.literal(-delta)])
+                     for written_class, delta in (written or {}).items() if delta)
+        images = db.union_all(*parts).alias('images_counts')
+        counts = db.select([images.c.smear_id, images.c.cell_class, db.func.sum(images.c.cells)])\
+            .where(~db.exists().where(table.c.smear_id == smear_id))\
+            .group_by(images.c.smear_id, images.c.cell_class)\
+            .having(db.func.sum(images.c.cells) != 0)
+        db.session.execute(insert(table).from_select(['smear_id', 'cell_class', 'cells'], counts)
+                           .on_conflict_do_nothing())
+
+    @staticmethod
+    def tuples(smear_id):
+        """
+        Current (class index, count) of a smear in the format used by diff_pickle
+        Counters of smears imported before they existed are built on first use
+        in the transaction of the caller
+        """
+        query = db.session.query(SmearClassCount.cell_class, SmearClassCount.cells)\
+            .filter(SmearClassCount.smear_id == smear_id)
+        rows = query.all()
+        if not rows:
+            SmearClassCount.build(smear_id)
+            rows = query.all()
+        return sorted((cell_class, cells) for cell_class, cells in rows if cells > 0)
+
+    @staticmethod
+    def on_after_flush(session, flush_context):
+        """
+        Function to invoke after every flush
+        Count images added, deleted or reclassified through the session
+        """
+        deltas = Tally()
+        for step, objects in ((1, session.new), (-1, session.deleted)):
+            for obj in objects:
+                if isinstance(obj, CellImage):
+                    deltas[(obj.smear_id, obj.nucleated_cell_class or 0)] += step
+        for obj in session.dirty:
+            if isinstance(obj, CellImage):
+                history = db.inspect(obj).attrs.nucleated_cell_class.history
+                if history.added and history.deleted:
+                    deltas[(obj.smear_id, history.deleted[0] or 0)] -= 1
+                    deltas[(obj.smear_id, history.added[0] or 0)] += 1
+        SmearClassCount.apply(deltas)
+
+
+# listener of SQLAlchemy
+db.event.listen(db.session, 'after_flush', SmearClassCount.on_after_flush)
+
 
 class Comment(db.Model):
     """
@@ -527,9 +1203,11 @@ class PathReview(db.Model):
     :review: final comment by patholgist after analyzing sample
     """
     __tablename__ = 'reviews'
+    # partial index of the pending review worklist
+    __table_args__ = (db.Index('ix_reviews_pending', 'sample_id', postgresql_where=db.text('status IS false')),)
     id = db.Column(db.Integer, primary_key=True)
-    sample_id = db.Column(db.Integer, db.ForeignKey('samples.id'))
-    status = db.Column(db.Boolean, default=False)
+    sample_id = db.Column(db.Integer, db.ForeignKey('samples.id'), index=True)
+    status = db.column_property(db.Column(db.Boolean, default=False), active_history=True)
     review_for = db.Column(db.Text)
     review = db.Column(db.Text)
 
@@ -541,7 +1219,7 @@ class PathReview(db.Model):
         """
         Function to calculate current pending pathologist reviews
         """
-        return PathReview.query.filter_by(status=False).count()
+        return Counter.get('pending_reviews')
 
 
 class Morphology(db.Model):
@@ -576,7 +1254,102 @@ class BloodMorphology(db.Model):
     """
     __tablename__ = "blood_morphologies"
     smear_id = db.Column(db.Integer, db.ForeignKey("smears.id"), primary_key=True)
-    morph_id = db.Column(db.Integer, db.ForeignKey("morphs.id"), primary_key=True)
+    # primary key starts with smear_id, morph_id needs its own index
+    morph_id = db.Column(db.Integer, db.ForeignKey("morphs.id"), primary_key=True, index=True)
     # TODO # change degree to scale
     degree = db.Column(db.String(16))
     morphs = db.relationship(Morphology, lazy="joined")
+
+
+class Counter(db.Model):
+    """
+    Create a table counters
+    Summary counts kept current by session events,
+    so pages read them without COUNT(*) over large tables
+    :name: counter name eg- patients, pending_samples
+    :value: current count
+    """
+    __tablename__ = 'counters'
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "Counter: {} {}".format(self.name, self.value)
+
+    @staticmethod
+    def totals():
+        """
+        Counted models and the counter holding their row count
+        """
+        return {Patient: 'patients', Sample: 'samples', User: 'users', Clinic: 'clinics'}
+
+    @staticmethod
+    def pendings():
+        """
+        Models with a status column and the counter holding
+        the number of rows with status False
+        """
+        return {Sample: 'pending_samples', PathReview: 'pending_reviews'}
+
+    @staticmethod
+    def get(name):
+        """
+        Current value of a single counter
+        """
+        return db.session.query(Counter.value).filter_by(name=name).scalar() or 0
+
+    @staticmethod
+    def get_many(*names):
+        """
+        Current values of several counters in one query
+        """
+        values = dict(db.session.query(Counter.name, Counter.value).filter(Counter.name.in_(names)).all())
+        return {name: values.get(name, 0) for name in names}
+
+    @staticmethod
+    def rebuild():
+        """
+        Repair function, recompute every counter from the tables
+        """
+        values = {name: model.query.count() for model, name in Counter.totals().items()}
+        values.update({name: model.query.filter_by(status=False).count()
+                       for model, name in Counter.pendings().items()})
+        for name, value in values.items():
+            counter = Counter.query.get(name) or Counter(name=name)
+            counter.value = value
+            db.session.add(counter)
+        db.session.commit()
+        return values
+
+    @staticmethod
+    def on_before_flush(session, flush_context, instances):
+        """
+        Function to invoke before every flush
+        Collect count changes of new, deleted and status-changed rows
+        and apply them in the same transaction as the flush
+        """
+        totals = Counter.totals()
+        pendings = Counter.pendings()
+        deltas = Tally()
+        for step, objects in ((1, session.new), (-1, session.deleted)):
+            for obj in objects:
+                model = type(obj)
+                if model in totals:
+                    deltas[totals[model]] += step
+                if model in pendings and not obj.status:
+                    deltas[pendings[model]] += step
+        for obj in session.dirty:
+            model = type(obj)
+            if model in pendings:
+                history = db.inspect(obj).attrs.status.history
+                if history.added and history.deleted:
+                    deltas[pendings[model]] += (not history.added[0]) - (not history.deleted[0])
+        for name, delta in deltas.items():
+            if delta:
+                session.execute(Counter.__table__.update()
+                                .where(Counter.name == name)
+                                .values(value=Counter.value + delta))
+
+
+# listener of SQLAlchemy
+db.event.listen(db.session, 'before_flush', Counter.on_before_flush)
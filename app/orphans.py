@@ -0,0 +1,156 @@
+import time
+from itertools import islice
+from sqlalchemy.dialects.postgresql import insert, JSONB
+from . import db
+from .models import CellImage, PackEntry, Smear, User
+from .storage import storage
+
+# folders of the objects stored by the app
+PREFIXES = ('slide_images/', 'profile_images/', 'packs/', 'sprites/')
+# keys used by the app that no row references
+RESERVED = {'default.jpg'}
+HEX = set('0123456789abcdef')
+
+# keys referenced when the collection started, on the connection of the collection
+referenced_keys = db.Table('gc_referenced_keys', db.MetaData(), db.Column('key', db.Text, primary_key=True),
+                           prefixes=['TEMPORARY'])
+
+UNREFERENCED = db.text('SELECT listed.key FROM unnest(:keys) AS listed(key) WHERE NOT EXISTS '
+                       '(SELECT 1 FROM gc_referenced_keys WHERE gc_referenced_keys.key = listed.key)')
+
+
+def atlas_keys():
+    """
+    Select of the atlas keys of the sprite manifests
+    """
+    atlases = db.func.jsonb_array_elements(Smear.sprite['atlases'], type_=JSONB)
+    return db.select([atlases['key'].astext]).where(Smear.sprite.isnot(None))
+
+
+def snapshot(connection):
+    """
+    Copy every referenced key into the temporary table referenced_keys:
+    images and their variants, profile images, packs and sprite atlases
+    returns the number of keys
+    """
+    referenced_keys.create(connection)
+    connection.execute(referenced_keys.insert().from_select(['key'], db.union(
+        db.select([CellImage.img]),
+        db.select([CellImage.img_grid]).where(CellImage.img_grid.isnot(None)),
+        db.select([CellImage.img_medium]).where(CellImage.img_medium.isnot(None)),
+        db.select([User.profile_image]),
+        db.select([PackEntry.pack]),
+        atlas_keys())))
+    connection.execute(insert(referenced_keys).values([{'key': key} for key in RESERVED]).on_conflict_do_nothing())
+    connection.execute('ANALYZE gc_referenced_keys')
+    return connection.execute(db.select([db.func.count()]).select_from(referenced_keys)).scalar()
+
+
+def checksum_prefix(key):
+    """
+    First 32 hex digits of the SHA-256 of an image, the name of its
+    content-derived keys, None for other keys
+    """
+    prefix = key.rsplit('/', 1)[-1][:32]
+    if len(prefix) == 32 and all(c in HEX for c in prefix):
+        return prefix
+    return None
+
+
+def referenced(keys):
+    """
+    Keys still referenced by a row, checked right before they are deleted.
+    Images are deduplicated by content so a row stored after the snapshot
+    may reuse an old object. Images are found by the indexed checksum their
+    keys are named after, keys of other images are never reused
+    """
+    keys = list(keys)
+    found = set(RESERVED)
+    prefixes = {prefix for prefix in map(checksum_prefix, keys) if prefix}
+    if prefixes:
+        rows = db.session.query(CellImage.img, CellImage.img_grid, CellImage.img_medium)\
+            .filter(db.or_(*[CellImage.checksum.between(prefix + '0' * 32, prefix + 'f' * 32)
+                             for prefix in sorted(prefixes)]))
+        found.update(key for row in rows for key in row)
+    found.update(key for key, in db.session.query(User.profile_image).filter(User.profile_image.in_(keys)))
+    found.update(key for key, in db.session.query(PackEntry.pack).filter(PackEntry.pack.in_(keys)).distinct())
+    # atlas keys start with the smear id, sprites/<smear id>-<digest>-<n>
+    smear_ids = {key.split('/', 1)[1].split('-', 1)[0] for key in keys if key.startswith('sprites/')}
+    smear_ids = [int(smear_id) for smear_id in smear_ids if smear_id.isdigit()]
+    if smear_ids:
+        found.update(key for key, in db.session.execute(atlas_keys().where(Smear.id.in_(smear_ids))))
+    db.session.rollback()
+    return found.intersection(keys)
+
+
+def unreferenced(connection, prefixes, min_age, counters):
+    """
+    Yield (key, size) of the objects under prefixes missing from the
+    snapshot and stored at least min_age seconds ago. Listings are read a
+    page at a time and each page is anti-joined with the snapshot
+    """
+    started = time.time()
+    for prefix in prefixes:
+        listing = storage.list(prefix)
+        page = list(islice(listing, 1000))
+        while page:
+            counters['listed'] += len(page)
+            sizes = {key: size for key, modified, size in page if started - modified >= min_age}
+            counters['recent'] += len(page) - len(sizes)
+            if sizes:
+                for key, in connection.execute(UNREFERENCED, keys=list(sizes)):
+                    yield key, sizes[key]
+            page = list(islice(listing, 1000))
+
+
+def collect(app, prefixes=PREFIXES, min_age=24 * 3600, dry_run=False, batch_size=1000, rate=2.0, limit=0,
+            echo=print):
+    """
+    Delete the stored objects no row references
+    Objects stored less than min_age seconds ago are kept, their rows may
+    not be committed yet. Orphans are checked again against the live rows
+    and deleted batch_size keys per request, at most rate requests per
+    second and limit objects (0 for no limit). A dry run echoes the keys
+    it would delete
+    returns the counters of the collection
+    """
+    counters = dict.fromkeys(['referenced_keys', 'listed', 'recent', 'orphans', 'reused', 'deleted',
+                              'deleted_bytes', 'failed'], 0)
+    connection = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    next_delete = 0.0
+
+    def delete(batch):
+        nonlocal next_delete
+        reused = referenced(batch)
+        counters['reused'] += len(reused)
+        batch = {key: size for key, size in batch.items() if key not in reused}
+        if dry_run:
+            for key in sorted(batch):
+                echo(key)
+        elif batch:
+            time.sleep(max(next_delete - time.monotonic(), 0))
+            next_delete = time.monotonic() + 1 / rate
+            for key, error in storage.delete_many(sorted(batch)):
+                app.logger.warning('Failed to delete %s: %s', key, error)
+                counters['failed'] += 1
+                del batch[key]
+        counters['deleted'] += len(batch)
+        counters['deleted_bytes'] += sum(batch.values())
+
+    try:
+        counters['referenced_keys'] = snapshot(connection)
+        pending = {}
+        for key, size in unreferenced(connection, prefixes, min_age, counters):
+            counters['orphans'] += 1
+            pending[key] = size
+            if len(pending) >= batch_size:
+                delete(pending)
+                pending = {}
+            if counters['orphans'] == limit:
+                break
+        if pending:
+            delete(pending)
+    finally:
+        referenced_keys.drop(connection, checkfirst=True)
+        connection.close()
+    return counters
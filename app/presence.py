@@ -0,0 +1,73 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta
+from . import db
+from .models import User
+
+
+class VisitTracker:
+    """
+    Per-worker buffer of user last visits
+    Requests only record the visit in memory, at most once per
+    LAST_VISIT_GRANULARITY seconds per user. A background thread writes
+    the buffered visits every LAST_VISIT_FLUSH_INTERVAL seconds
+    in a single UPDATE statement
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seen = {}
+        self.pending = {}
+        self.thread = None
+
+    def touch(self, app, user_id):
+        """
+        Record a visit of user, no database access
+        """
+        now = datetime.utcnow()
+        granularity = timedelta(seconds=app.config['LAST_VISIT_GRANULARITY'])
+        with self.lock:
+            last = self.seen.get(user_id)
+            if last is not None and now - last < granularity:
+                return
+            self.seen[user_id] = now
+            self.pending[user_id] = now
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, args=[app], daemon=True)
+                self.thread.start()
+                atexit.register(self.flush, app)
+
+    def run(self, app):
+        """
+        Background thread, flush buffered visits every interval
+        """
+        while True:
+            time.sleep(app.config['LAST_VISIT_FLUSH_INTERVAL'])
+            self.flush(app)
+
+    def flush(self, app):
+        """
+        Write buffered visits in one executemany UPDATE,
+        visits are put back in the buffer if the write fails
+        """
+        with self.lock:
+            visits, self.pending = self.pending, {}
+        if not visits:
+            return
+        statement = User.__table__.update()\
+            .where(User.id == db.bindparam('visit_user'))\
+            .values(last_visit=db.bindparam('visit_ts'))
+        try:
+            with app.app_context():
+                db.session.execute(statement, [{'visit_user': user_id, 'visit_ts': ts}
+                                               for user_id, ts in visits.items()])
+                db.session.commit()
+        except Exception:
+            app.logger.exception('Failed to write last visits')
+            with self.lock:
+                for user_id, ts in visits.items():
+                    self.pending.setdefault(user_id, ts)
+
+
+visit_tracker = VisitTracker()
@@ -0,0 +1,186 @@
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from flask import Response
+from . import imaging
+from .utils import get_image_pool
+
+
+class ResizeCache:
+    """
+    Resized cell images kept in a size-bounded disk cache shared by the
+    workers of a host. File modification times order the entries, a hit
+    touches its file and the oldest files are removed once the cache grows
+    over RESIZE_CACHE_MAX_BYTES. Eviction takes a lock file, a worker finding
+    it taken skips the eviction. Counters are per worker
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.max_bytes = 0
+        self.lock = threading.Lock()
+        # in-process lock per key stripe, concurrent misses of a key resize once
+        self.key_locks = [threading.Lock() for _ in range(64)]
+        self.written = 0
+        self.counters = dict.fromkeys(['hits', 'misses', 'not_modified', 'bytes_served', 'bytes_written',
+                                       'evicted_files', 'evicted_bytes'], 0)
+
+    def init_app(self, app):
+        self.directory = app.config['RESIZE_CACHE_DIR']
+        self.max_bytes = app.config['RESIZE_CACHE_MAX_BYTES']
+
+    def count(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counters[name] += value
+
+    @staticmethod
+    def params(app, args):
+        """
+        (width, height, quality, format) of request arguments w, h, q and fmt
+        Sizes are rounded up to a multiple of 32 pixels and bounded by
+        RESIZE_MAX_SIZE so few variants of an image are cached
+        raise ValueError on invalid arguments
+        """
+        width = int(args.get('w') or args.get('h') or 0)
+        height = int(args.get('h') or width)
+        if width <= 0 or height <= 0:
+            raise ValueError('w or h is required')
+        limit = app.config['RESIZE_MAX_SIZE']
+        width, height = [min(-(-size // 32) * 32, limit) for size in (width, height)]
+        quality = min(max(int(args.get('q') or app.config['IMAGE_QUALITY']), 30), 95)
+        image_format = (args.get('fmt') or app.config['IMAGE_FORMAT']).upper()
+        if image_format == 'JPG':
+            image_format = 'JPEG'
+        if image_format not in imaging.FORMATS:
+            raise ValueError('Unknown format {}'.format(image_format))
+        return width, height, quality, image_format
+
+    def path(self, key, image_format):
+        return os.path.join(self.directory, key[:2], key + imaging.FORMATS[image_format][1])
+
+    def send(self, app, request, image, width, height, quality, image_format):
+        """
+        Response with the resized image, from the cache or resized from the
+        original in the image process pool. The ETag is derived from the
+        image content and the parameters, it is strong and never changes
+        """
+        source = image.checksum or image.img
+        key = hashlib.sha1('{}|{}x{}|{}|{}'.format(source, width, height, quality, image_format).encode())\
+            .hexdigest()
+        response = Response(mimetype=imaging.FORMATS[image_format][0])
+        response.set_etag(key)
+        response.cache_control.private = True
+        response.cache_control.max_age = 31536000
+        if key in request.if_none_match:
+            self.count(not_modified=1)
+            return response.make_conditional(request)
+        path = self.path(key, image_format)
+        data = self.read(path)
+        if data is None:
+            with self.key_locks[int(key[:8], 16) % len(self.key_locks)]:
+                data = self.read(path)
+                if data is None:
+                    self.count(misses=1)
+                    _, results = get_image_pool().submit(imaging.transcode, image.read(), [('proxy', (width, height))],
+                                                         image_format, quality).result()
+                    data = results[0][1]
+                    self.write(path, data)
+        else:
+            self.count(hits=1)
+        self.count(bytes_served=len(data))
+        response.set_data(data)
+        return response.make_conditional(request)
+
+    def read(self, path):
+        """
+        Bytes of a cached file, touched when it was not used for a minute
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+                if time.time() - os.fstat(f.fileno()).st_mtime > 60:
+                    os.utime(path)
+                return data
+        except FileNotFoundError:
+            return None
+
+    def write(self, path, data):
+        """
+        Write a file atomically, evict after every tenth of the cache size written
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+        with self.lock:
+            self.counters['bytes_written'] += len(data)
+            self.written += len(data)
+            evict = self.written >= self.max_bytes // 10
+            if evict:
+                self.written = 0
+        if evict:
+            self.evict()
+
+    def scan(self):
+        """
+        (modification time, size, path) of the cached files
+        """
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache
+        is back under 90% of RESIZE_CACHE_MAX_BYTES
+        """
+        with open(os.path.join(self.directory, '.evict.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            files = sorted(self.scan())
+            total = sum(size for _, size, _ in files)
+            evicted_files = evicted_bytes = 0
+            for _, size, path in files:
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                evicted_files += 1
+                evicted_bytes += size
+        self.count(evicted_files=evicted_files, evicted_bytes=evicted_bytes)
+
+    def stats(self):
+        """
+        Counters of the worker with hit rate, files and bytes of the shared cache
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / total, 4) if total else 0.0
+        files = self.scan() if os.path.isdir(self.directory) else []
+        stats['files'] = len(files)
+        stats['size'] = sum(size for _, size, _ in files)
+        stats['max_size'] = self.max_bytes
+        return stats
+
+
+resize_cache = ResizeCache()
@@ -0,0 +1,110 @@
+import hashlib
+from threading import Thread, Lock
+from . import db, imaging
+from .models import CellImage, Smear, PackEntry
+from .storage import storage
+from .utils import get_upload_pool, get_image_pool
+
+# smears whose atlases are being built by this process
+_building = set()
+_building_lock = Lock()
+
+
+def digest(image_ids):
+    """
+    Signature of the images of a smear covered by a manifest
+    """
+    return hashlib.sha1(','.join(str(image_id) for image_id in sorted(image_ids)).encode()).hexdigest()[:16]
+
+
+def manifest(app, smear, image_ids):
+    """
+    Sprite manifest of a smear for the diff grid, None when SPRITE_ATLAS
+    is off or the atlases were never built. A missing or stale manifest
+    (images were added since) is built in the background for the next
+    view, images it does not cover are shown one by one meanwhile
+    """
+    if not app.config['SPRITE_ATLAS'] or not image_ids:
+        return None
+    sprite = smear.sprite
+    if sprite is None or sprite['digest'] != digest(image_ids):
+        build_async(app, smear.id)
+    return sprite
+
+
+def build(app, smear_id):
+    """
+    Pack the grid thumbnails of a smear into atlases, upload them and store
+    the manifest on the smear. Thumbnails are read with the upload pool,
+    by range reads for packed images, and packed in the image pool.
+    Unreadable thumbnails are left out
+    returns the manifest
+        {'digest': signature of the images,
+         'atlases': [{'key', 'width', 'height'}],
+         'cells': {str(image id): [atlas, x, y, width, height]}}
+    JSON object keys are strings, cells are looked up by str(image id)
+    """
+    upload_pool = get_upload_pool()
+    rows = db.session.query(CellImage.id, db.func.coalesce(CellImage.img_grid, CellImage.img))\
+        .filter(CellImage.smear_id == smear_id).order_by(CellImage.id).all()
+    entries = {entry.key: (entry.pack, entry.offset, entry.length)
+               for entry in PackEntry.query.filter_by(smear_id=smear_id)}
+    db.session.rollback()
+
+    def read(key):
+        if key in entries:
+            return storage.read(*entries[key])
+        return storage.read(key)
+
+    reads = [(image_id, upload_pool.submit(read, key)) for image_id, key in rows]
+    images = []
+    for image_id, future in reads:
+        try:
+            images.append((image_id, future.result()))
+        except Exception as e:
+            app.logger.warning('Failed to read image %s for the sprite of smear %s: %s', image_id, smear_id, e)
+    image_format = app.config['IMAGE_FORMAT']
+    content_type, ext = imaging.FORMATS[image_format]
+    atlases, cells = get_image_pool().submit(imaging.pack, images, app.config['SPRITE_MAX_SIZE'],
+                                             app.config['IMAGE_VARIANTS']['grid'], image_format,
+                                             app.config['IMAGE_QUALITY']).result()
+    signature = digest(image_id for image_id, _ in rows)
+    keys = ['sprites/{}-{}-{}{}'.format(smear_id, signature, n, ext) for n in range(len(atlases))]
+    uploads = [upload_pool.submit(storage.put_new, key, data, content_type)
+               for key, (data, _, _) in zip(keys, atlases)]
+    for upload in uploads:
+        upload.result()
+    sprite = {'digest': signature,
+              'atlases': [{'key': key, 'width': width, 'height': height}
+                          for key, (_, width, height) in zip(keys, atlases)],
+              'cells': {str(image_id): list(cell) for image_id, cell in cells.items()}}
+    # atlases of an older manifest are left for views rendered with it
+    Smear.query.filter_by(id=smear_id).update({'sprite': sprite}, synchronize_session=False)
+    db.session.commit()
+    return sprite
+
+
+def build_async(app, smear_id):
+    """
+    Build the atlases of a smear in a background thread,
+    nothing when SPRITE_ATLAS is off or this process is building them already
+    """
+    if not app.config['SPRITE_ATLAS']:
+        return
+    with _building_lock:
+        if smear_id in _building:
+            return
+        _building.add(smear_id)
+    Thread(target=_build, args=(app, smear_id)).start()
+
+
+def _build(app, smear_id):
+    with app.app_context():
+        try:
+            build(app, smear_id)
+        except Exception:
+            app.logger.exception('Failed to build the sprite of smear %s', smear_id)
+        finally:
+            db.session.remove()
+            with _building_lock:
+                _building.discard(smear_id)
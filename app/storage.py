@@ -0,0 +1,379 @@
+import io
+import mimetypes
+import os
+import tempfile
+import time
+from threading import Lock
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
+from flask import Response, abort, current_app, redirect, send_file, url_for
+from werkzeug.security import safe_join
+from .cache import TTLCache
+
+# one S3 client per worker process, keyed by pid so
+# forked workers never share the connections of their parent
+_s3_lock = Lock()
+_s3_clients = {}
+# smear images are small, upload each one in a single request on the calling thread
+_s3_transfer = TransferConfig(use_threads=False)
+# presigned URLs of private objects by key, per worker
+presign_cache = TTLCache()
+# headers of an object kept when it is copied onto itself
+S3_COPIED_HEADERS = ('ContentType', 'CacheControl', 'ContentDisposition', 'ContentEncoding', 'ContentLanguage',
+                     'Expires')
+
+
+def get_s3(app=None):
+    """
+    get aws s3 client
+    The client is created once per worker, boto3 clients are thread-safe
+    and reuse the pooled connections sized by S3_MAX_POOL_CONNECTIONS
+    """
+    pid = os.getpid()
+    s3 = _s3_clients.get(pid)
+    if s3 is None:
+        app = app or current_app
+        with _s3_lock:
+            s3 = _s3_clients.get(pid)
+            if s3 is None:
+                s3 = boto3.client('s3', aws_access_key_id=app.config['AWS_ACCESS_KEY_ID'],
+                                  aws_secret_access_key=app.config['AWS_SECRET_ACCESS_KEY'],
+                                  endpoint_url=app.config['S3_ENDPOINT_URL'],
+                                  config=BotoConfig(max_pool_connections=app.config['S3_MAX_POOL_CONNECTIONS'],
+                                                    retries={'max_attempts': 3}))
+                _s3_clients[pid] = s3
+    return s3
+
+
+def put_file_to_s3(s3, bucket_name, file, file_name, acl, content_type=None):
+    """
+    upload one file, no app context needed, exceptions are raised
+    content type defaults to the content type of the uploaded file
+    """
+    s3.upload_fileobj(
+        file,
+        bucket_name,
+        file_name,
+        ExtraArgs={
+            "ACL": acl,
+            "ContentType": content_type or file.content_type
+        },
+        Config=_s3_transfer
+    )
+    return file_name
+
+
+def put_new_file_to_s3(s3, bucket_name, data, file_name, acl, content_type, max_age):
+    """
+    upload bytes unless the key already exists, keys of images are derived
+    from their content so an existing key already holds the same bytes.
+    An existing object stored more than max_age seconds ago is touched
+    instead, see touch_file_in_s3
+    returns True if the file was uploaded
+    """
+    try:
+        touch_file_in_s3(s3, bucket_name, file_name, acl, max_age)
+        return False
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+    put_file_to_s3(s3, bucket_name, io.BytesIO(data), file_name, acl, content_type)
+    return True
+
+
+def touch_file_in_s3(s3, bucket_name, file_name, acl, max_age):
+    """
+    refresh the LastModified of an object stored more than max_age seconds
+    ago by copying it onto itself. A copy onto the same key must replace the
+    metadata, the headers read by a HEAD request are copied back unchanged
+    returns True if the object was copied, raises ClientError if it does not exist
+    """
+    head = s3.head_object(Bucket=bucket_name, Key=file_name)
+    if time.time() - head['LastModified'].timestamp() < max_age:
+        return False
+    headers = {name: head[name] for name in S3_COPIED_HEADERS if name in head}
+    s3.copy_object(Bucket=bucket_name, Key=file_name, CopySource={'Bucket': bucket_name, 'Key': file_name},
+                   MetadataDirective='REPLACE', ACL=acl, Metadata=head.get('Metadata', {}), **headers)
+    return True
+
+
+def read_range_from_s3(s3, bucket_name, file_name, offset, length):
+    """
+    read length bytes of an object from offset with a range request
+    """
+    return s3.get_object(Bucket=bucket_name, Key=file_name,
+                         Range='bytes={}-{}'.format(offset, offset + length - 1))['Body'].read()
+
+
+class S3Storage:
+    """
+    Objects of the bucket AWS_STORAGE_BUCKET_NAME, served by the bucket at S3_LOCATION
+    With S3_PRIVATE objects are stored private and linked with presigned
+    URLs, cached in presign_cache until S3_PRESIGN_MARGIN seconds before
+    they expire
+    Methods need no app context, they run on the upload pool threads
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.private = app.config['S3_PRIVATE']
+        self.expires = app.config['S3_PRESIGN_EXPIRES']
+        presign_cache.ttl = max(self.expires - app.config['S3_PRESIGN_MARGIN'], 0)
+        presign_cache.maxsize = app.config['S3_PRESIGN_CACHE_MAXSIZE']
+
+    def client(self):
+        return get_s3(self.app)
+
+    @property
+    def bucket_name(self):
+        return self.app.config['AWS_STORAGE_BUCKET_NAME']
+
+    def acl(self, acl):
+        return 'private' if self.private else acl
+
+    def put(self, key, data, content_type, acl='public-read'):
+        put_file_to_s3(self.client(), self.bucket_name, io.BytesIO(data), key, self.acl(acl), content_type)
+
+    def put_new(self, key, data, content_type, acl='public-read'):
+        return put_new_file_to_s3(self.client(), self.bucket_name, data, key, self.acl(acl), content_type,
+                                  self.app.config['STORAGE_TOUCH_AFTER'])
+
+    def touch(self, key, acl='public-read'):
+        touch_file_in_s3(self.client(), self.bucket_name, key, self.acl(acl), self.app.config['STORAGE_TOUCH_AFTER'])
+
+    def read(self, key, offset=0, length=None):
+        if length is not None:
+            return read_range_from_s3(self.client(), self.bucket_name, key, offset, length)
+        return self.client().get_object(Bucket=self.bucket_name, Key=key)['Body'].read()
+
+    def delete(self, key):
+        self.client().delete_object(Bucket=self.bucket_name, Key=key)
+
+    def delete_many(self, keys):
+        response = self.client().delete_objects(Bucket=self.bucket_name,
+                                                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+        return [(error['Key'], error['Message']) for error in response.get('Errors', [])]
+
+    def list(self, prefix=''):
+        paginator = self.client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for item in page.get('Contents', []):
+                yield item['Key'], item['LastModified'].timestamp(), item['Size']
+
+    def presign(self, keys):
+        """
+        {key: presigned GET URL} of keys, signing is local to the client,
+        no request is sent to S3
+        """
+        s3 = self.client()
+        return {key: s3.generate_presigned_url('get_object', Params={'Bucket': self.bucket_name, 'Key': key},
+                                               ExpiresIn=self.expires)
+                for key in keys}
+
+    def url(self, key):
+        if self.private:
+            return self.sign([key])[key]
+        return '{}/{}'.format(self.app.config['S3_LOCATION'], key)
+
+    def sign(self, keys):
+        if self.private:
+            return presign_cache.get_many(keys, self.presign)
+        return {key: self.url(key) for key in keys}
+
+    def send(self, key):
+        return redirect(self.url(key))
+
+
+class LocalStorage:
+    """
+    Files under STORAGE_LOCAL_ROOT, keys are paths relative to it
+    Files are served by the app with conditional GETs, or handed to the
+    front server with X-Sendfile (USE_X_SENDFILE) or X-Accel-Redirect to
+    the internal location STORAGE_ACCEL_REDIRECT
+    """
+
+    def __init__(self, app):
+        self.root = app.config['STORAGE_LOCAL_ROOT']
+        self.accel_redirect = app.config['STORAGE_ACCEL_REDIRECT']
+
+    def path(self, key):
+        path = safe_join(self.root, key)
+        if path is None:
+            raise ValueError('Invalid storage key {}'.format(key))
+        return path
+
+    def put(self, key, data, content_type=None, acl=None):
+        """
+        write through a temporary file so readers never see a partial file
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(temp, 0o644)
+            os.replace(temp, path)
+        except Exception:
+            os.remove(temp)
+            raise
+
+    def put_new(self, key, data, content_type=None, acl=None):
+        """
+        an existing file holds the same bytes, its mtime is refreshed for collect-orphans
+        """
+        try:
+            os.utime(self.path(key))
+            return False
+        except FileNotFoundError:
+            pass
+        self.put(key, data, content_type)
+        return True
+
+    def touch(self, key, acl=None):
+        os.utime(self.path(key))
+
+    def read(self, key, offset=0, length=None):
+        with open(self.path(key), 'rb') as f:
+            f.seek(offset)
+            return f.read(-1 if length is None else length)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+        return []
+
+    def list(self, prefix=''):
+        start = os.path.dirname(self.path(prefix)) if prefix and not prefix.endswith('/') else self.path(prefix)
+        for root, folders, files in os.walk(start):
+            folders.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if not key.startswith(prefix):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield key, stat.st_mtime, stat.st_size
+
+    def url(self, key):
+        return url_for('main.storage_file', key=key)
+
+    def sign(self, keys):
+        return {key: self.url(key) for key in keys}
+
+    def send(self, key):
+        try:
+            path = self.path(key)
+        except ValueError:
+            abort(404)
+        if not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        if self.accel_redirect:
+            response = Response(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = '{}/{}'.format(self.accel_redirect.rstrip('/'), key)
+        else:
+            response = send_file(path, mimetype=mimetype, conditional=True)
+        # stored files are private to logged in users, their keys never change content
+        response.cache_control.public = False
+        response.cache_control.private = True
+        response.cache_control.max_age = 31536000
+        return response
+
+
+DRIVERS = {'s3': S3Storage, 'local': LocalStorage}
+
+
+class Storage:
+    """
+    Image storage of the app, the driver is picked by STORAGE_BACKEND
+    Templates get storage_url(key), pages linking many objects sign their
+    keys in one batch first so the template reads cached URLs
+    """
+
+    def __init__(self):
+        self.driver = None
+
+    def init_app(self, app):
+        self.driver = DRIVERS[app.config['STORAGE_BACKEND']](app)
+        app.jinja_env.globals['storage_url'] = self.url
+
+    def put(self, key, data, content_type, acl='public-read'):
+        """
+        store bytes under key, replacing any existing object
+        """
+        self.driver.put(key, data, content_type, acl)
+
+    def put_new(self, key, data, content_type, acl='public-read'):
+        """
+        store bytes unless key exists, keys of images are derived from their content
+        so a retried upload skips the objects already stored. Existing objects
+        are touched, see touch
+        returns True if the bytes were stored
+        """
+        return self.driver.put_new(key, data, content_type, acl)
+
+    def touch(self, key, acl='public-read'):
+        """
+        refresh the modification time of an object reused by a new row, so
+        collect-orphans sees it as recent, raises if the object does not exist
+        S3 objects are only read unless they were stored more than
+        STORAGE_TOUCH_AFTER seconds ago
+        """
+        self.driver.touch(key, acl)
+
+    def read(self, key, offset=0, length=None):
+        """
+        bytes of an object, length bytes from offset with a range read
+        """
+        return self.driver.read(key, offset, length)
+
+    def delete(self, key):
+        self.driver.delete(key)
+
+    def delete_many(self, keys):
+        """
+        delete up to 1000 keys in one request
+        returns [(key, error)] of the keys that were not deleted
+        """
+        return self.driver.delete_many(keys)
+
+    def list(self, prefix=''):
+        """
+        yield (key, modification time, size) of the objects under prefix,
+        the listing is streamed page by page
+        """
+        return self.driver.list(prefix)
+
+    def url(self, key):
+        """
+        URL of an object for templates
+        """
+        return self.driver.url(key)
+
+    def sign(self, keys):
+        """
+        {key: URL} of many objects, URLs of private objects are
+        presigned in one batch and cached until shortly before they expire
+        """
+        return self.driver.sign(keys)
+
+    def send(self, key):
+        """
+        response serving an object
+        """
+        return self.driver.send(key)
+
+
+storage = Storage()
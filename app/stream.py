@@ -0,0 +1,115 @@
+import json
+import queue
+import threading
+import time
+from .models import Counter
+
+
+class PendingHub:
+    """
+    Per-worker publisher of pending counts for Server-Sent Events
+    One background thread reads the counters table and pushes changes
+    to subscriber queues, idle subscribers hold no database connection but
+    hold a request thread, their number is capped per worker.
+    The thread only runs while there is at least one subscriber
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.values = None
+        self.thread = None
+
+    def subscribe(self, app):
+        """
+        Register a new subscriber queue, seeded with the last known counts
+        Each stream holds a request thread, None is returned when the worker
+        already serves PENDING_STREAM_MAX_SUBSCRIBERS streams
+        """
+        subscriber = queue.Queue(maxsize=app.config['PENDING_STREAM_QUEUE'])
+        with self.lock:
+            if len(self.subscribers) >= app.config['PENDING_STREAM_MAX_SUBSCRIBERS']:
+                return None
+            self.subscribers.add(subscriber)
+            if self.values is not None:
+                subscriber.put_nowait(('pending', self.pending_data(self.values)))
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, args=[app], daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        Remove a subscriber queue once the stream is closed
+        """
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def run(self, app):
+        """
+        Background thread, read the counters every interval
+        and publish them when they change
+        """
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    self.values = None
+                    return
+            try:
+                with app.app_context():
+                    values = Counter.get_many('pending_samples', 'pending_reviews', 'samples')
+            except Exception:
+                app.logger.exception('Failed to read pending counters')
+            else:
+                self.publish(values)
+            time.sleep(app.config['PENDING_STREAM_INTERVAL'])
+
+    @staticmethod
+    def pending_data(values):
+        """
+        Pending counts in the same format as the lab.pending route
+        """
+        return [values['pending_samples'], values['pending_reviews']]
+
+    def publish(self, values):
+        """
+        Push changed counts, and a new-sample alert when samples were added,
+        to every subscriber. Full queues of slow clients drop the message
+        """
+        if values == self.values:
+            return
+        messages = [('pending', self.pending_data(values))]
+        if self.values is not None and values['samples'] > self.values['samples']:
+            messages.append(('new_sample', values['samples'] - self.values['samples']))
+        with self.lock:
+            self.values = values
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            for message in messages:
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    pass
+
+    def stream(self, app, subscriber):
+        """
+        Generator of Server-Sent Events for one subscriber
+        Heartbeat comments detect closed connections, and the stream
+        ends after PENDING_STREAM_TIMEOUT so the browser reconnects
+        The subscriber is removed when the response is closed, see lab.pending_stream,
+        a generator closed before it started never runs its finally clause
+        """
+        heartbeat = app.config['PENDING_STREAM_HEARTBEAT']
+        deadline = time.time() + app.config['PENDING_STREAM_TIMEOUT']
+        yield 'retry: {}\n\n'.format(app.config['PENDING_STREAM_INTERVAL'] * 1000)
+        while time.time() < deadline:
+            try:
+                name, data = subscriber.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ': heartbeat\n\n'
+                continue
+            yield 'event: {}\ndata: {}\n\n'.format(name, json.dumps(data))
+
+
+pending_hub = PendingHub()
@@ -5,8 +5,10 @@ from . import users
 from .forms import EditProfileForm, ChangePasswordForm, ResetRequestForm, ResetPasswordForm,\
     ContactAdminForm
 from .. import database
+from ..cache import user_cache
 from ..models import User
-from ..utils import send_email, save_image, upload_file_to_s3
+from ..storage import storage
+from ..utils import send_email, save_image, store_file
 
 
 @users.route('/edit_profile', methods=['GET', 'POST'])
@@ -18,18 +20,21 @@ def edit_profile():
     """
     form = EditProfileForm()
     if form.validate_on_submit():
-        current_user.username = form.username.data
+        user = current_user.model()
+        user.username = form.username.data
         if form.user_image.data:
-            image_file = upload_file_to_s3(form.user_image.data, "profile_images")
-            current_user.profile_image = image_file
-        # db.session.add(current_user._get_current_object())
-        # db.session.commit()
-        database.update(current_user._get_current_object())
+            image_file = store_file(form.user_image.data, "profile_images")
+            if image_file:
+                user.profile_image = image_file
+            else:
+                flash('Your profile image could not be uploaded, the previous image is kept', 'danger')
+        database.update(user)
+        user_cache.invalidate(user.id)
         flash('Your Profile has been updated!', 'success')
         return redirect(url_for('users.edit_profile'))
     elif request.method == 'GET':
         form.username.data = current_user.username
-    picture_file = url_for('static', filename='images/profile_img/' + current_user.profile_image)
+    picture_file = storage.url(current_user.profile_image)
     return render_template('users/edit_profile.html', form=form,
                            image_file=picture_file)
 
@@ -43,11 +48,11 @@ def change_password():
     """
     form = ChangePasswordForm()
     if form.validate_on_submit():
-        if current_user.verify_password(form.old_password.data):
-            current_user.password = form.password.data
-            # db.session.add(current_user)
-            # db.session.commit()
-            database.update(current_user)
+        user = current_user.model()
+        if user.verify_password(form.old_password.data):
+            user.password = form.password.data
+            database.update(user)
+            user_cache.invalidate(user.id)
             flash('Your password has been updated.', 'success')
             return redirect(url_for('main.index'))
         else:
@@ -107,6 +112,7 @@ def all_users():
     Allows to excess all users info
     """
     users = User.query.order_by(User.id.desc()).all()
+    storage.sign({user.profile_image for user in users})
     return render_template('/users/users.html', users=users)
 
 
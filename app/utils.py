@@ -1,18 +1,24 @@
 import os
+import hashlib
 import secrets
 import random
 import string
-import boto3
+import io
+import sys
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from enum import Enum
 from dateutil.relativedelta import *
+from sqlalchemy import or_
 from datetime import date
-from flask import current_app, render_template, abort
+from flask import current_app, render_template, abort, jsonify
 from flask_login import current_user
-from app import mail
+from app import mail, imaging
+from app.storage import storage
 from PIL import Image
 from functools import wraps
 from flask_mail import Message
-from threading import Thread
+from threading import Thread, Lock
 
 
 # runs thread in the background
@@ -124,6 +130,17 @@ class OrderEventType(Enum):
     DISCARD = 'Smear Discarded'
 
 
+class IngestStatus(Enum):
+    """
+    Enum to capture state of the
+    background upload of smear images
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
 class Classifier(Enum):
     """
     Different type of cells present
@@ -176,29 +193,83 @@ def define_roles():
 
 def save_image(picture, output_size=(350, 350), folder='slide_images'):
     """
-    function to store images on the server
+    function to store a resized image
     Blood cells images have default image size of 350X350
+    returns the key of the stored image
     """
-    random_hex = secrets.token_hex(8)
-    _, file_ext = os.path.splitext(picture.filename)
-    file_name = random_hex + file_ext
-    picture_path = os.path.join(current_app.root_path,
-                                'static/images/' + folder,
-                                file_name)
+    file_name = s3_file_name(picture, folder)
     pic = Image.open(picture)
+    image_format = pic.format
     pic.thumbnail(output_size)
-    pic.save(picture_path)
+    buffer = io.BytesIO()
+    pic.save(buffer, image_format)
+    storage.put(file_name, buffer.getvalue(), Image.MIME.get(image_format))
     return file_name
 
 
-def get_s3():
+# one upload pool and image pool per worker process, keyed by pid so
+# forked workers never share the threads of their parent
+_pool_lock = Lock()
+_upload_pools = {}
+_image_pools = {}
+# error message prefix of images rejected by store_images as duplicates
+DUPLICATE_IMAGE = 'Duplicate image'
+
+
+def get_upload_pool():
     """
-    get aws s3 object
+    get the bounded thread pool of S3 uploads, shared by all requests of the worker
     """
-    app = get_app()
-    s3 = boto3.client('s3', aws_access_key_id=app.config['AWS_ACCESS_KEY_ID'],
-                      aws_secret_access_key=app.config['AWS_SECRET_ACCESS_KEY'])
-    return s3
+    pid = os.getpid()
+    pool = _upload_pools.get(pid)
+    if pool is None:
+        app = get_app()
+        with _pool_lock:
+            pool = _upload_pools.get(pid)
+            if pool is None:
+                pool = ThreadPoolExecutor(max_workers=app.config['S3_UPLOAD_WORKERS'])
+                _upload_pools[pid] = pool
+    return pool
+
+
+def init_image_pool(app):
+    """
+    Make the fork server the start method of the process on Python 3.6,
+    where ProcessPoolExecutor takes no mp_context. A child forked from a
+    worker running request threads inherits locks held by other threads
+    (logging, connection pools) and can deadlock
+    """
+    if sys.version_info >= (3, 7):
+        return
+    try:
+        multiprocessing.set_start_method('forkserver')
+    except RuntimeError:
+        # the start method was already set
+        pass
+    if multiprocessing.get_start_method() != 'forkserver':
+        app.logger.warning('Image pool processes are started with %s, they may deadlock in threaded workers',
+                           multiprocessing.get_start_method())
+
+
+def get_image_pool():
+    """
+    get the process pool resizing cell images, shared by all requests of the worker
+    Pool processes are started by a fork server, never forked from the threaded worker,
+    on Python 3.6 through the start method set by init_image_pool
+    """
+    pid = os.getpid()
+    pool = _image_pools.get(pid)
+    if pool is None:
+        app = get_app()
+        with _pool_lock:
+            pool = _image_pools.get(pid)
+            if pool is None:
+                kwargs = {}
+                if sys.version_info >= (3, 7):
+                    kwargs['mp_context'] = multiprocessing.get_context('forkserver')
+                pool = ProcessPoolExecutor(max_workers=app.config['IMAGE_WORKERS'], **kwargs)
+                _image_pools[pid] = pool
+    return pool
 
 
 def get_bucket_name():
@@ -209,41 +280,203 @@ def get_bucket_name():
     return app.config['AWS_STORAGE_BUCKET_NAME']
 
 
-def upload_file_to_s3(file, folder="slide_images", acl="public-read"):
+def s3_file_name(file, folder):
     """
-    function to upload a file to aws bucket
+    random key of an uploaded file in folder, keeps the file extension
     """
-    # TODO image resizeing
-    s3 = get_s3()
-    bucket_name = get_bucket_name()
-    random_hex = secrets.token_hex(8)
     _, file_ext = os.path.splitext(file.filename)
-    file_name = random_hex + file_ext
-    file_name = folder + '/' + file_name
+    return folder + '/' + secrets.token_hex(8) + file_ext
+
+
+class Pack:
+    """
+    Images of one upload written to storage as a single object
+    :entries: {image key: (offset, length, content type)} within the pack
+    """
+
+    def __init__(self, folder='packs'):
+        self.folder = folder
+        self.buffer = io.BytesIO()
+        self.entries = {}
+        self.key = None
+
+    def add(self, file_name, data, content_type):
+        if file_name not in self.entries:
+            self.entries[file_name] = (self.buffer.tell(), len(data), content_type)
+            self.buffer.write(data)
+
+    def upload(self, acl):
+        """
+        store the pack under a key derived from its content
+        """
+        data = self.buffer.getvalue()
+        self.key = '{}/{}.pack'.format(self.folder, hashlib.sha256(data).hexdigest()[:32])
+        storage.put_new(self.key, data, 'application/octet-stream', acl)
+        return self.key
+
+
+def read_hashed(file, chunk_size=64 * 1024):
+    """
+    read an uploaded file chunk by chunk, hashing it on the way
+    returns (bytes, sha256 hex digest)
+    """
+    digest = hashlib.sha256()
+    buffer = io.BytesIO()
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        digest.update(chunk)
+        buffer.write(chunk)
+    return buffer.getvalue(), digest.hexdigest()
+
+
+def store_file(file, folder="slide_images", acl="public-read"):
+    """
+    function to store an uploaded file under a random key
+    returns the file key, or False if storing failed
+    """
+    key = s3_file_name(file, folder)
     try:
-        s3.upload_fileobj(
-            file,
-            bucket_name,
-            file_name,
-            ExtraArgs={
-                "ACL": acl,
-                "ContentType": file.content_type
-            }
-        )
-    except Exception as e:
-        # TODO better way to handle exception
+        storage.put(key, file.read(), file.content_type, acl)
+    except Exception:
+        get_app().logger.exception('Failed to store %s', file.filename)
         return False
-    return file_name
+    return key
 
 
-def delete_file_from_s3(key):
+def store_files(files, folder="slide_images", acl="public-read"):
+    """
+    function to store many files concurrently
+    with the bounded upload pool of the worker
+    returns (list of (file name, key) in the order of files,
+             list of (file name, error message) of failed files)
     """
-    function to delete file from s3 bucket
+    app = get_app()
+    pool = get_upload_pool()
+    futures = []
+    for file in files:
+        key = s3_file_name(file, folder)
+        futures.append((file.filename, key, pool.submit(storage.put, key, file.read(), file.content_type, acl)))
+    stored = []
+    failed = []
+    for filename, key, future in futures:
+        try:
+            future.result()
+            stored.append((filename, key))
+        except Exception as e:
+            app.logger.warning('Failed to store %s: %s', filename, e)
+            failed.append((filename, str(e)))
+    return stored, failed
+
+
+def store_images(files, folder="slide_images", acl="public-read", stored=None, pack=None):
+    """
+    function to store cell images with their resized variants
+    Images are stored under keys derived from their SHA-256, objects already
+    in storage are not written again. Reused objects are touched to mark them
+    recent for collect-orphans, see Storage.touch. Images are resized in the worker
+    process pool, the original and every variant of IMAGE_VARIANTS are
+    stored with the bounded upload pool
+    :stored: function of a list of checksums returning
+             ({checksum: CellImage fields} of images already stored,
+              set of checksums already in the smear), see CellImage.stored.
+             Stored images are reused without resizing, images already in
+             the smear are rejected as duplicates
+    :pack: Pack collecting the images and variants, stored as one object.
+           Images are not reused from other smears, whose packs hold them
+    returns (list of (file name, CellImage fields) in the order of files,
+             list of (file name, error message) of failed images)
+    """
+    app = get_app()
+    upload_pool = get_upload_pool()
+    variants = sorted(app.config['IMAGE_VARIANTS'].items())
+    image_format = app.config['IMAGE_FORMAT']
+    content_type, variant_ext = imaging.FORMATS[image_format]
+    failed = []
+    hashed = []
+    names = {}
+    for file in files:
+        data, checksum = read_hashed(file)
+        if checksum in names:
+            failed.append((file.filename, '{} of {}'.format(DUPLICATE_IMAGE, names[checksum])))
+            continue
+        names[checksum] = file.filename
+        hashed.append((file, data, checksum))
+    known, in_smear = stored(list(names)) if stored else ({}, set())
+    if pack is not None:
+        known = {}
+    # reused objects are touched so collect-orphans sees them as recent,
+    # an object deleted meanwhile is stored again
+    touches = [(checksum, upload_pool.submit(storage.touch, known[checksum][column], acl))
+               for checksum in names if checksum in known and checksum not in in_smear
+               for column in ('img', 'img_grid', 'img_medium') if known[checksum][column]]
+    for checksum, touch in touches:
+        try:
+            touch.result()
+        except Exception as e:
+            app.logger.info('Stored image %s is not reused: %s', checksum, e)
+            known.pop(checksum, None)
+    resizes = []
+    for file, data, checksum in hashed:
+        if checksum in in_smear:
+            failed.append((file.filename, '{} already in the smear'.format(DUPLICATE_IMAGE)))
+        elif checksum in known:
+            resizes.append((file, data, checksum, None))
+        else:
+            resizes.append((file, data, checksum,
+                            get_image_pool().submit(imaging.transcode, data, variants, image_format,
+                                                    app.config['IMAGE_QUALITY'])))
+    pending = []
+    for file, data, checksum, resize in resizes:
+        if resize is None:
+            pending.append((file.filename, dict(known[checksum]), []))
+            continue
+        try:
+            (width, height), results = resize.result()
+        except Exception as e:
+            app.logger.warning('Failed to resize %s: %s', file.filename, e)
+            failed.append((file.filename, str(e)))
+            continue
+        # 128 bits of the digest keep keys within the 64 characters of images.img
+        base = '{}/{}'.format(folder, checksum[:32])
+        original = base + os.path.splitext(file.filename)[1].lower()
+        fields = {'img': original, 'width': width, 'height': height, 'checksum': checksum}
+        objects = [(original, data, file.content_type)]
+        for name, variant, variant_width, variant_height in results:
+            key = '{}_{}{}'.format(base, name, variant_ext)
+            fields.update({'img_' + name: key, name + '_width': variant_width, name + '_height': variant_height})
+            objects.append((key, variant, content_type))
+        if pack is not None:
+            for key, body, body_type in objects:
+                pack.add(key, body, body_type)
+            pending.append((file.filename, fields, []))
+        else:
+            pending.append((file.filename, fields, [upload_pool.submit(storage.put_new, key, body, body_type, acl)
+                                                    for key, body, body_type in objects]))
+    if pack is not None and pack.entries:
+        try:
+            pack.upload(acl)
+        except Exception as e:
+            app.logger.warning('Failed to store the pack of %s images: %s', len(pending), e)
+            failed.extend((filename, str(e)) for filename, _, _ in pending)
+            pending = []
+    uploaded = []
+    for filename, fields, uploads in pending:
+        try:
+            for upload in uploads:
+                upload.result()
+        except Exception as e:
+            app.logger.warning('Failed to store %s: %s', filename, e)
+            failed.append((filename, str(e)))
+        else:
+            uploaded.append((filename, fields))
+    return uploaded, failed
+
+
+def delete_file(key):
+    """
+    function to delete a stored file
     """
-    s3 = get_s3()
-    bucket_name = get_bucket_name()
     try:
-        s3.delete_object(Bucket=bucket_name, Key=key)
+        storage.delete(key)
     except Exception as e:
         # TODO better way to handle exception
         return False
@@ -273,6 +506,70 @@ def admin_required(f):
     return privilege_required(Privilege.ADMIN)(f)
 
 
+def datatable_params(args, max_length=100):
+    """
+    Parse DataTables server-side processing parameters
+    (draw/start/length/search/order) from request args.
+    Ordering columns are resolved through 'columns[i][name]'
+    and fall back to 'columns[i][data]'
+    """
+    draw = args.get('draw', 0, type=int)
+    start = max(args.get('start', 0, type=int), 0)
+    length = args.get('length', max_length, type=int)
+    if length < 1 or length > max_length:
+        length = max_length
+    order = []
+    i = 0
+    while 'order[{}][column]'.format(i) in args:
+        column = args.get('order[{}][column]'.format(i), type=int)
+        name = args.get('columns[{}][name]'.format(column)) or args.get('columns[{}][data]'.format(column))
+        direction = 'desc' if args.get('order[{}][dir]'.format(i)) == 'desc' else 'asc'
+        order.append((name, direction))
+        i += 1
+    return {'draw': draw, 'start': start, 'length': length,
+            'search': args.get('search[value]', '').strip(), 'order': order}
+
+
+def datatable_order(query, order, columns, tie_breaker):
+    """
+    Apply DataTables ordering to a query
+    param: order - list of (column name, direction) from datatable_params
+    param: columns - dict of sortable column name to SQL expression
+    param: tie_breaker - unique column that keeps paging stable
+    """
+    clauses = []
+    for name, direction in order:
+        column = columns.get(name)
+        if column is not None:
+            clauses.append(column.desc() if direction == 'desc' else column.asc())
+    clauses.append(tie_breaker.desc() if not clauses else tie_breaker.asc())
+    return query.order_by(*clauses)
+
+
+def datatable_search(query, term, columns, id_column=None):
+    """
+    Filter a query so every word of the search term matches
+    one of the text columns, numbers may also match the id column
+    """
+    for word in term.split():
+        like = '%{}%'.format(word)
+        criteria = [column.ilike(like) for column in columns]
+        if id_column is not None and word.isdigit():
+            criteria.append(id_column == int(word))
+        query = query.filter(or_(*criteria))
+    return query
+
+
+def datatable_response(params, total, filtered, data):
+    """
+    JSON response in DataTables server-side processing format
+    """
+    return jsonify({'draw': params['draw'],
+                    'recordsTotal': total,
+                    'recordsFiltered': filtered,
+                    'data': data})
+
+
 def calculate_delta(dob):
     """
     Calculate time difference between now and birthdate
@@ -22,12 +22,96 @@ class Config:
     MAIL_SENDER = os.environ.get('MAIL_SENDER_HEMOGRAM')
 
     # files storage config
+    # s3, or local: files under STORAGE_LOCAL_ROOT served by the app at /storage/<key>
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 's3').lower()
+    STORAGE_LOCAL_ROOT = os.environ.get('STORAGE_LOCAL_ROOT', os.path.join(basedir, 'storage'))
+    # local files sent by the front server, X-Sendfile (Apache, lighttpd) or X-Accel-Redirect
+    # to the internal nginx location aliased to STORAGE_LOCAL_ROOT, eg- /protected-storage
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', 'false').lower() == 'true'
+    STORAGE_ACCEL_REDIRECT = os.environ.get('STORAGE_ACCEL_REDIRECT')
+    # seconds after which a reused object is refreshed so `flask collect-orphans` sees it as recent,
+    # must stay well below its --min-age
+    STORAGE_TOUCH_AFTER = int(os.environ.get('STORAGE_TOUCH_AFTER', 6 * 3600))
     AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
     AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
     AWS_STORAGE_BUCKET_NAME = os.environ.get('AWS_STORAGE_BUCKET_NAME')
-    S3_LOCATION = 'https://s3.amazonaws.com/{}'.format(AWS_STORAGE_BUCKET_NAME)
+    # endpoint of an S3 compatible stand-in for local runs and benchmarks, eg- http://localhost:5005
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+    S3_LOCATION = os.environ.get('S3_LOCATION', 'https://s3.amazonaws.com/{}'.format(AWS_STORAGE_BUCKET_NAME))
+    # private objects are linked with presigned URLs valid S3_PRESIGN_EXPIRES seconds,
+    # signatures are cached per worker and renewed S3_PRESIGN_MARGIN seconds before they expire
+    S3_PRIVATE = os.environ.get('S3_PRIVATE', 'false').lower() == 'true'
+    S3_PRESIGN_EXPIRES = int(os.environ.get('S3_PRESIGN_EXPIRES', 3600))
+    S3_PRESIGN_MARGIN = int(os.environ.get('S3_PRESIGN_MARGIN', 300))
+    S3_PRESIGN_CACHE_MAXSIZE = int(os.environ.get('S3_PRESIGN_CACHE_MAXSIZE', 100000))
     AWS_S3_FILE_OVERWRITE = False
     AWS_DEFAULT_ACL = None
+    # connections of the per-worker S3 client and threads uploading smear images
+    S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 32))
+    S3_UPLOAD_WORKERS = int(os.environ.get('S3_UPLOAD_WORKERS', 16))
+
+    # resized variants of cell images, (max width, max height) of the grid and medium CellImage columns
+    IMAGE_VARIANTS = {'grid': (255, 255), 'medium': (512, 512)}
+    # JPEG (progressive) or WEBP
+    IMAGE_FORMAT = os.environ.get('IMAGE_FORMAT', 'JPEG').upper()
+    IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 85))
+    # processes resizing images, per worker
+    IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', os.cpu_count() or 1))
+
+    # images of each upload stored as one pack object indexed by pack_entries,
+    # served by range reads instead of one object per image
+    SMEAR_PACK = os.environ.get('SMEAR_PACK', 'false').lower() == 'true'
+
+    # diff grid thumbnails of a smear packed into atlases of at most SPRITE_MAX_SIZE pixels a side,
+    # the grid loads one image per atlas instead of one per cell
+    SPRITE_ATLAS = os.environ.get('SPRITE_ATLAS', 'false').lower() == 'true'
+    SPRITE_MAX_SIZE = int(os.environ.get('SPRITE_MAX_SIZE', 4096))
+
+    # resized images of /lab/images/<id>/resized cached on local disk, shared by the workers of a host
+    RESIZE_CACHE_DIR = os.environ.get('RESIZE_CACHE_DIR', os.path.join(basedir, 'resize_cache'))
+    RESIZE_CACHE_MAX_BYTES = int(os.environ.get('RESIZE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+    RESIZE_MAX_SIZE = 1024
+
+    # asynchronous ingest, add_sample stages images and `flask ingest-worker` uploads them
+    # the worker must see the staging directory of the web process (same host or shared volume)
+    INGEST_ASYNC = os.environ.get('INGEST_ASYNC', 'false').lower() == 'true'
+    INGEST_STAGING_DIR = os.environ.get('INGEST_STAGING_DIR', os.path.join(basedir, 'staging'))
+    # images committed together, seconds between polls of an idle worker,
+    # seconds after which a running job is taken over, attempts before a job fails
+    INGEST_CHUNK = 20
+    INGEST_POLL_INTERVAL = 2
+    INGEST_STALE_AFTER = 600
+    INGEST_MAX_ATTEMPTS = 3
+
+    # hot folder watcher of instrument exports (`flask watch-exports`)
+    # group 1 of the pattern searched in an export name is the order id, by default the name starts
+    # with it followed by _ or . eg- 1234_smear.zip, other names are skipped eg- 2024-05-01_1234.zip
+    HOTFOLDER_ACCESSION = os.environ.get('HOTFOLDER_ACCESSION', r'^(\d+)(?:[_.]|$)')
+    HOTFOLDER_MARKER = os.environ.get('HOTFOLDER_MARKER', '.complete')
+    HOTFOLDER_STABLE_SECONDS = int(os.environ.get('HOTFOLDER_STABLE_SECONDS', 30))
+    HOTFOLDER_WORKERS = int(os.environ.get('HOTFOLDER_WORKERS', 4))
+
+    # pending counts push (Server-Sent Events) config, intervals in seconds
+    PENDING_STREAM = os.environ.get('PENDING_STREAM', 'true').lower() == 'true'
+    PENDING_STREAM_INTERVAL = 2
+    PENDING_STREAM_HEARTBEAT = 15
+    PENDING_STREAM_TIMEOUT = 300
+    PENDING_STREAM_QUEUE = 16
+    # streams held open per worker, each holds a gunicorn thread until PENDING_STREAM_TIMEOUT,
+    # clients over the limit get 204 and poll every PENDING_POLL_INTERVAL instead
+    PENDING_STREAM_MAX_SUBSCRIBERS = int(os.environ.get('PENDING_STREAM_MAX_SUBSCRIBERS', 8))
+    PENDING_POLL_INTERVAL = 60
+
+    # user last visit tracking, in seconds
+    LAST_VISIT_GRANULARITY = int(os.environ.get('LAST_VISIT_GRANULARITY', 60))
+    LAST_VISIT_FLUSH_INTERVAL = int(os.environ.get('LAST_VISIT_FLUSH_INTERVAL', 30))
+
+    # per-worker cache of logged in users, ttl in seconds
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 60))
+    USER_CACHE_MAXSIZE = 1024
+
+    # delay in milliseconds before queued cell moves of the diff page are saved
+    DIFF_FLUSH_DELAY = 400
 
     @staticmethod
     def init_app(app):
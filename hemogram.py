@@ -1,9 +1,22 @@
 import os
+import time
+import io
+import click
+import boto3
+from flask import render_template, render_template_string
 from flask_migrate import Migrate
+from sqlalchemy.schema import CreateIndex
 from app import create_app, db
 from app.models import User, Role, Privilege, LabProcedure, Patient, Clinic,\
     Order, Event, Sample, Smear, CellImage, Comment, PathReview, Morphology,\
-    BloodMorphology, Provider
+    BloodMorphology, Provider, Counter, SmearClassCount, DiffResult, IngestJob
+from app.utils import InstrumentType, wbc_classification, diff_pickle, store_files, store_images, s3_file_name
+from app.storage import storage, put_file_to_s3, get_s3
+from app.differential import BatchDifferential
+from app import ingest
+from app.cellavision import import_archive
+from app.hotfolder import HotFolder
+from app import orphans
 app = create_app(os.environ.get('LAB_CONFIG'))
 migrate = Migrate(app, db)
 
@@ -15,7 +28,8 @@ def make_shell_context():
                 Order=Order, Event=Event, Sample=Sample, Smear=Smear,
                 CellImage=CellImage, Comment=Comment, PathReview=PathReview,
                 Morphology=Morphology, BloodMorphology=BloodMorphology,
-                Provider=Provider)
+                Provider=Provider, Counter=Counter, SmearClassCount=SmearClassCount,
+                DiffResult=DiffResult, IngestJob=IngestJob)
 
 
 @app.context_processor
@@ -42,3 +56,453 @@ def test():
 def deploy():
     db.create_all()
     Role.preset_roles()
+    Counter.rebuild()
+    SmearClassCount.rebuild()
+    # default profile image of users, at the root of storage
+    with open(os.path.join(app.static_folder, 'images', 'profile_img', 'default.jpg'), 'rb') as f:
+        storage.put_new('default.jpg', f.read(), 'image/jpeg')
+
+
+@app.cli.command('repair-counters')
+def repair_counters():
+    """
+    Recompute summary counters and smear class counters from the tables
+    """
+    for name, value in sorted(Counter.rebuild().items()):
+        print('{}: {}'.format(name, value))
+    SmearClassCount.rebuild()
+    print('smear class counters: {}'.format(SmearClassCount.query.count()))
+
+
+@app.cli.command('bench-diff')
+def bench_diff():
+    """
+    Benchmark the differential cell grid of smears with 100, 1,000 and
+    10,000 cells, the former template looping over smear.images once per
+    class vs the images pre-grouped by Smear.image_groups. The smears are
+    added to a seeded sample and rolled back
+    """
+    classification = wbc_classification()
+    legacy = """
+    {%for i in range(classification | length)%}
+       <fieldset class="box my-1" id="{{classification[i]}}">
+          <legend>{{classification[i] | capitalize}}</legend>
+          {%for cell_image in smear.images%}
+             {% if cell_image.nucleated_cell_class == i%}
+                <div id='{{cell_image.id}}' name='box-cell'>
+                   <img class="img-thumbnail-diff" src="{{config.S3_LOCATION}}/{{cell_image.img}}" alt="">
+                </div>
+             {% endif %}
+          {% endfor %}
+       </fieldset>
+    {% endfor %}"""
+    sample = Sample.query.order_by(Sample.id.desc()).first()
+    if sample is None:
+        raise click.ClickException('Database has no samples, run seed-bench first')
+    statements = []
+
+    def count_statement(*args):
+        statements.append(args[2])
+
+    db.event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        with app.test_request_context():
+            for size in (100, 1000, 10000):
+                smear = Smear(instrument_type=InstrumentType.CELLAVISION, sample_id=sample.id)
+                db.session.add(smear)
+                db.session.flush()
+                db.session.execute(CellImage.__table__.insert().values(
+                    [{'img': 'bench/{}-{}.jpg'.format(smear.id, i), 'smear_id': smear.id,
+                      'nucleated_cell_class': i % len(classification)} for i in range(size)]))
+                timings = {}
+                for name in ('per class loop', 'pre-grouped'):
+                    best = None
+                    for _ in range(3):
+                        db.session.expire_all()
+                        del statements[:]
+                        start = time.perf_counter()
+                        if name == 'pre-grouped':
+                            render_template('_cell_grid.html', smear=smear,
+                                            cell_groups=smear.image_groups(classification))
+                        else:
+                            render_template_string(legacy, classification=classification, smear=smear)
+                        elapsed = time.perf_counter() - start
+                        best = elapsed if best is None else min(best, elapsed)
+                    timings[name] = (best, len(statements))
+                print('{:>6} cells: per class loop {:8.1f} ms ({} queries), pre-grouped {:8.1f} ms ({} queries)'
+                      .format(size, timings['per class loop'][0] * 1000, timings['per class loop'][1],
+                              timings['pre-grouped'][0] * 1000, timings['pre-grouped'][1]))
+                db.session.rollback()
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+
+@app.cli.command('ingest-worker')
+@click.option('--once', is_flag=True, help='Exit when no job is waiting.')
+def ingest_worker(once):
+    """
+    Upload images staged by add_sample in asynchronous ingest mode
+    """
+    ingest.run(app, once)
+
+
+@app.cli.command('import-smears')
+@click.argument('archives', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--smear', 'smear_id', type=int, help='Smear of a single smear export.')
+@click.option('--user', 'username', required=True, help='Username recorded on the RECEIVED_SMEAR events.')
+def import_smears(archives, smear_id, username):
+    """
+    Import CellaVision export archives (zip or tar), into one smear with
+    --smear or as batches with one folder per sample id
+    """
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException('No user {}'.format(username))
+    smear = None
+    if smear_id is not None:
+        smear = Smear.query.get(smear_id)
+        if smear is None:
+            raise click.ClickException('No smear {}'.format(smear_id))
+    for path in archives:
+        start = time.perf_counter()
+        with open(path, 'rb') as fileobj:
+            imported, failed = import_archive(app, fileobj, user.id, smear)
+        print('{}: {} images imported into {} smears in {:.1f} s, {} failed'.format(
+            path, sum(imported.values()), len(imported), time.perf_counter() - start, len(failed)))
+        for name, error in failed:
+            print('  {}: {}'.format(name, error))
+
+
+@app.cli.command('watch-exports')
+@click.argument('directories', nargs=-1, required=True, type=click.Path(exists=True, file_okay=False))
+@click.option('--user', 'username', required=True, help='Username recorded on the RECEIVED_SMEAR events.')
+@click.option('--checkpoint', default='hotfolder.json', help='File of the exports already imported.')
+@click.option('--interval', default=10, help='Seconds between polls of the directories.')
+@click.option('--once', is_flag=True, help='Import the complete exports and exit.')
+def watch_exports(directories, username, checkpoint, interval, once):
+    """
+    Watch directories of instrument exports and import complete
+    exports into the smear of their order
+    """
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException('No user {}'.format(username))
+    HotFolder(app, directories, user.id, checkpoint).run(interval, once)
+
+
+@app.cli.command('diff-archive')
+@click.option('--rewrite', is_flag=True, help='Store recomputed results instead of only verifying.')
+@click.option('--batch-size', default=1000, help='Number of samples per batch.')
+def diff_archive(rewrite, batch_size):
+    """
+    Recompute or verify stored differentials of every validated sample
+    with the vectorized differential engine, batch by batch
+    """
+    checked = mismatched = reference_mismatched = 0
+    last_id = 0
+    while True:
+        samples = Sample.query.options(db.selectinload(Sample.diff_results))\
+            .filter(Sample.status.is_(True), Sample.id > last_id)\
+            .order_by(Sample.id).limit(batch_size).all()
+        if not samples:
+            break
+        last_id = samples[-1].id
+        position = {sample.id: i for i, sample in enumerate(samples)}
+        rows = [[] for _ in samples]
+        counts = db.session.query(Smear.sample_id, CellImage.nucleated_cell_class, db.func.count(CellImage.id))\
+            .join(CellImage, CellImage.smear_id == Smear.id)\
+            .filter(Smear.sample_id.in_(list(position)))\
+            .group_by(Smear.sample_id, CellImage.nucleated_cell_class)
+        for sample_id, cell_class, count in counts:
+            rows[position[sample_id]].append((cell_class or 0, count))
+        engine = BatchDifferential.from_tuples(rows, [sample.wbc for sample in samples])
+        for i, sample in enumerate(samples):
+            report = engine.report(i)
+            if report != diff_pickle(sample.wbc, list(rows[i])):
+                reference_mismatched += 1
+            stored = sample.differential() or {}
+            if report != {'diff': stored.get('diff'), 'total': stored.get('total')}:
+                mismatched += 1
+                if rewrite:
+                    report['morph'] = stored.get('morph', [])
+                    sample.store_diff(report)
+            checked += 1
+        if rewrite:
+            db.session.commit()
+        else:
+            db.session.expunge_all()
+    print('{} samples checked, {} stored reports differ{}, {} differ from diff_pickle'.format(
+        checked, mismatched, ' and were rewritten' if rewrite else '', reference_mismatched))
+
+
+@app.cli.command('backfill-diff')
+@click.option('--batch-size', default=1000, help='Number of samples per batch.')
+def backfill_diff(batch_size):
+    """
+    Convert pickled diff_report of validated samples to diff_results rows
+    Each batch is committed on its own, converted samples have diff_total
+    set and are skipped, so an interrupted backfill resumes where it stopped
+    """
+    results = DiffResult.__table__
+    samples = Sample.__table__
+    update = samples.update().where(samples.c.id == db.bindparam('sample'))\
+        .values(diff_total=db.bindparam('total'), diff_morph=db.bindparam('morph'))
+    converted = 0
+    last_id = 0
+    while True:
+        batch = db.session.query(Sample.id, Sample.diff_report)\
+            .filter(Sample.status.is_(True), Sample.diff_total.is_(None),
+                    Sample.diff_report.isnot(None), Sample.id > last_id)\
+            .order_by(Sample.id).limit(batch_size).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+        rows = [row for sample_id, report in batch for row in DiffResult.rows(report, sample_id)]
+        db.session.execute(results.delete().where(results.c.sample_id.in_([sample_id for sample_id, _ in batch])))
+        if rows:
+            db.session.execute(results.insert(), rows)
+        db.session.execute(update, [{'sample': sample_id, 'total': report.get('total', 0),
+                                     'morph': report.get('morph', [])} for sample_id, report in batch])
+        db.session.commit()
+        converted += len(batch)
+        print('{} samples converted, last sample id {}'.format(converted, last_id))
+    print('{} samples converted'.format(converted))
+
+
+@app.cli.command('create-indexes')
+def create_indexes():
+    """
+    Create indexes declared on the models that are missing from an existing
+    database. db.create_all only creates indexes together with new tables.
+    Indexes are built concurrently so the tables stay writable
+    """
+    inspector = db.inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    connection = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                if index.name in existing:
+                    print('{}: exists'.format(index.name))
+                    continue
+                index.dialect_options['postgresql']['concurrently'] = True
+                start = time.perf_counter()
+                connection.execute(CreateIndex(index))
+                print('{}: created in {:.1f} s'.format(index.name, time.perf_counter() - start))
+    finally:
+        connection.close()
+
+
+@app.cli.command('seed-bench')
+@click.option('--orders', default=10000, help='Number of orders, each with a sample and a smear.')
+@click.option('--images', default=50, help='Number of images per smear.')
+@click.option('--pending', default=0.05, help='Fraction of samples and reviews left pending.')
+@click.confirmation_option(prompt='Add synthetic rows to this database?')
+def seed_bench(orders, images, pending):
+    """
+    Fill a development database with synthetic patients, orders, samples,
+    smears, images, events and reviews for explain-queries and benchmarks
+    """
+    def seed(sql, **params):
+        result = db.session.execute(db.text(sql), params)
+        return result.scalar() if result.returns_rows else None
+
+    user = seed("""INSERT INTO users (username, user_first_name, user_last_name, email,
+                                      password_hash, profile_image, account_confirmed)
+                   VALUES ('bench', 'Bench', 'User', 'bench@example.com', '-', 'default.jpg', true)
+                   ON CONFLICT (username) DO UPDATE SET username = EXCLUDED.username RETURNING id""")
+    clinic = seed("""INSERT INTO clinics (clinic_code_name, clinic_full_name, added_by)
+                     VALUES ('BENCH', 'Bench Clinic', :user)
+                     ON CONFLICT (clinic_code_name) DO UPDATE SET clinic_full_name = EXCLUDED.clinic_full_name
+                     RETURNING id""", user=user)
+    provider = seed("""INSERT INTO providers (pro_first_name, pro_last_name, pro_middle_name, added_by, degree)
+                       VALUES ('Bench', 'Provider', '', :user, 'MD') RETURNING id""", user=user)
+    morph = seed("""INSERT INTO morphs (cell_type, morph_name, author_id)
+                    VALUES ('WBC', 'Bench morphology', :user) RETURNING id""", user=user)
+    patients = max(orders // 2, 1)
+    # ids of rows inserted by one statement are consecutive, the first id is enough
+    first_patient = seed("""WITH rows AS (
+                                INSERT INTO patients (pat_first_name, pat_last_name, pat_middle_name,
+                                                      birth_date, gender, registered_by)
+                                SELECT 'Bench', 'Patient ' || g, '', now() - g * interval '1 day',
+                                       'FEMALE', :user
+                                FROM generate_series(1, :patients) g RETURNING id)
+                            SELECT min(id) FROM rows""", user=user, patients=patients)
+    first_order = seed("""WITH rows AS (
+                              INSERT INTO orders (order_fluid_type, order_name, patient_id,
+                                                  order_loc_id, order_provider)
+                              SELECT 'WHOLE_BLOOD', 'CBD', :first_patient + g % :patients, :clinic, :provider
+                              FROM generate_series(1, :orders) g ORDER BY g RETURNING id)
+                          SELECT min(id) FROM rows""",
+                       first_patient=first_patient, patients=patients, clinic=clinic,
+                       provider=provider, orders=orders)
+    seed("""INSERT INTO events (order_id, user_id, event_ts, event_detail)
+            SELECT :first_order + g - 1, :user, now(), e
+            FROM generate_series(1, :orders) g,
+                 unnest(ARRAY['CREATED', 'RECEIVED_SAMPLE', 'RECEIVED_SMEAR']::actions[]) e""",
+         first_order=first_order, user=user, orders=orders)
+    first_sample = seed("""WITH rows AS (
+                               INSERT INTO samples (wbc, rbc, hgb, hct, plt, status, pathrv, order_id)
+                               SELECT 7.5, 4.5, 14.0, 42, 250, random() >= :pending, g % 20 = 0,
+                                      :first_order + g - 1
+                               FROM generate_series(1, :orders) g ORDER BY g RETURNING id)
+                           SELECT min(id) FROM rows""",
+                        pending=pending, first_order=first_order, orders=orders)
+    seed("""INSERT INTO reviews (sample_id, status, review_for)
+            SELECT id, random() >= :pending, 'bench' FROM samples WHERE id >= :first_sample AND pathrv""",
+         pending=pending, first_sample=first_sample)
+    first_smear = seed("""WITH rows AS (
+                              INSERT INTO smears (instrument_type, sample_id)
+                              SELECT 'CELLAVISION', :first_sample + g - 1
+                              FROM generate_series(1, :orders) g ORDER BY g RETURNING id)
+                          SELECT min(id) FROM rows""", first_sample=first_sample, orders=orders)
+    seed("""INSERT INTO images (img, nucleated_cell_class, smear_id)
+            SELECT 'bench/' || s || '-' || i || '.jpg', floor(random() * :classes), :first_smear + s - 1
+            FROM generate_series(1, :orders) s, generate_series(1, :images) i""",
+         classes=len(wbc_classification()), first_smear=first_smear, orders=orders, images=images)
+    seed("""INSERT INTO blood_morphologies (smear_id, morph_id)
+            SELECT :first_smear + g - 1, :morph FROM generate_series(1, :orders, 10) g""",
+         first_smear=first_smear, morph=morph, orders=orders)
+    db.session.commit()
+    Counter.rebuild()
+    SmearClassCount.rebuild()
+    connection = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    connection.execute('ANALYZE')
+    connection.close()
+    print('{} orders, {} patients and {} images added'.format(orders, patients, orders * images))
+
+
+@app.cli.command('explain-queries')
+@click.option('--analyze', is_flag=True, help='Run the queries with EXPLAIN ANALYZE.')
+def explain_queries(analyze):
+    """
+    Print the PostgreSQL plans of the hot worklist, feed and smear queries
+    Run on a seeded database before and after create-indexes to compare plans
+    """
+    smear = Smear.query.order_by(Smear.id.desc()).first()
+    order = Order.query.order_by(Order.id.desc()).first()
+    morph = Morphology.query.order_by(Morphology.id.desc()).first()
+    if smear is None or order is None or morph is None:
+        print('Database has no smears, orders or morphologies, run seed-bench first')
+        return
+    queries = [
+        ('pending sample worklist', Sample.worklist_query('pending').order_by(Sample.id.desc()).limit(25)),
+        ('pending review worklist',
+         Sample.worklist_query('pending', reviews=True).order_by(Sample.id.desc()).limit(25)),
+        ('order feed', Order.feed_query().order_by(Order.id.desc()).limit(25)),
+        ('pending sample count', db.session.query(db.func.count(Sample.id)).filter(Sample.status.is_(False))),
+        ('pending review count',
+         db.session.query(db.func.count(PathReview.id)).filter(PathReview.status.is_(False))),
+        ('orders of a patient', Order.query.filter_by(patient_id=order.patient_id)),
+        ('orders of a clinic', db.session.query(Order.id).filter_by(order_loc_id=order.order_loc_id).limit(25)),
+        ('events of an order', Event.query.filter_by(order_id=order.id).order_by(Event.id)),
+        ('smears of a sample', Smear.query.filter_by(sample_id=smear.sample_id)),
+        ('review of a sample', PathReview.query.filter_by(sample_id=smear.sample_id)),
+        ('images of a smear', db.session.query(CellImage.id, CellImage.img, CellImage.nucleated_cell_class)
+         .filter(CellImage.smear_id == smear.id).order_by(CellImage.id)),
+        ('class counts of a smear', db.session.query(CellImage.nucleated_cell_class, db.func.count(CellImage.id))
+         .filter(CellImage.smear_id == smear.id).group_by(CellImage.nucleated_cell_class)),
+        ('smears with a morphology', BloodMorphology.query.filter_by(morph_id=morph.id)),
+        ('samples with blasts above 20%', DiffResult.samples_above('blasts', 20)),
+    ]
+    prefix = 'EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN '
+    for name, query in queries:
+        statement = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+        print('-- {}'.format(name))
+        for line, in db.session.execute(prefix + str(statement)):
+            print(line)
+        print()
+    db.session.rollback()
+
+
+@app.cli.command('bench-upload')
+@click.option('--endpoint-url', default=None, help='S3 stand-in, defaults to S3_ENDPOINT_URL.')
+@click.option('--images', default=200, help='Number of images of the smear.')
+def bench_upload(endpoint_url, images):
+    """
+    Benchmark upload of a smear to a local S3 stand-in (moto_server, MinIO),
+    sequential uploads with a new client per file vs the pooled upload,
+    and the pooled upload of the original with its resized variants,
+    then again as a retry whose objects already exist
+    """
+    from PIL import Image
+    from werkzeug.datastructures import FileStorage
+    if app.config['STORAGE_BACKEND'] != 's3':
+        raise click.ClickException('bench-upload measures the s3 storage backend')
+    endpoint_url = endpoint_url or app.config['S3_ENDPOINT_URL']
+    if not endpoint_url:
+        raise click.ClickException('Set --endpoint-url or S3_ENDPOINT_URL, refusing to benchmark against AWS')
+    app.config['S3_ENDPOINT_URL'] = endpoint_url
+    bucket_name = app.config['AWS_STORAGE_BUCKET_NAME'] or 'hemogram-bench'
+    app.config['AWS_STORAGE_BUCKET_NAME'] = bucket_name
+    credentials = dict(aws_access_key_id=app.config['AWS_ACCESS_KEY_ID'] or 'bench',
+                       aws_secret_access_key=app.config['AWS_SECRET_ACCESS_KEY'] or 'bench')
+    app.config.update(AWS_ACCESS_KEY_ID=credentials['aws_access_key_id'],
+                      AWS_SECRET_ACCESS_KEY=credentials['aws_secret_access_key'])
+    payloads = []
+    for i in range(images):
+        # distinct images, identical ones would be stored once
+        buffer = io.BytesIO()
+        Image.effect_noise((360, 360), 64).convert('RGB').save(buffer, 'JPEG', quality=90)
+        payloads.append(buffer.getvalue())
+
+    def smear():
+        return [FileStorage(io.BytesIO(payload), filename='cell{}.jpg'.format(i), content_type='image/jpeg')
+                for i, payload in enumerate(payloads)]
+
+    with app.app_context():
+        s3 = get_s3()
+        try:
+            s3.create_bucket(Bucket=bucket_name)
+        except s3.exceptions.BucketAlreadyOwnedByYou:
+            pass
+        keys = []
+        start = time.perf_counter()
+        for file in smear():
+            client = boto3.client('s3', endpoint_url=endpoint_url, **credentials)
+            keys.append(put_file_to_s3(client, bucket_name, file, s3_file_name(file, 'bench'), 'public-read'))
+        sequential = time.perf_counter() - start
+        start = time.perf_counter()
+        uploaded, failed = store_files(smear(), 'bench')
+        pooled = time.perf_counter() - start
+        keys.extend(key for _, key in uploaded)
+        start = time.perf_counter()
+        resized, resize_failed = store_images(smear(), 'bench')
+        variants = time.perf_counter() - start
+        failed.extend(resize_failed)
+        start = time.perf_counter()
+        failed.extend(store_images(smear(), 'bench')[1])
+        retry = time.perf_counter() - start
+        keys.extend(fields[name] for _, fields in resized for name in fields if name.startswith('img'))
+        for i in range(0, len(keys), 1000):
+            s3.delete_objects(Bucket=bucket_name, Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]]})
+    print('{} images: sequential {:.2f} s, pooled {:.2f} s ({} workers), {:.1f}x faster, {} failed'.format(
+        images, sequential, pooled, app.config['S3_UPLOAD_WORKERS'], sequential / pooled, len(failed)))
+    print('pooled with {} resized variants: {:.2f} s ({} image processes)'.format(
+        len(app.config['IMAGE_VARIANTS']), variants, app.config['IMAGE_WORKERS']))
+    print('retry of the same smear, existing objects skipped: {:.2f} s'.format(retry))
+
+
+@app.cli.command('collect-orphans')
+@click.option('--prefix', 'prefixes', multiple=True, help='Key prefix to collect, repeatable. '
+              'Defaults to the folders of images, profile images, packs and sprites.')
+@click.option('--min-age', default=24.0, help='Hours an object is kept after it was stored.')
+@click.option('--batch-size', default=1000, type=click.IntRange(1, 1000), help='Keys per delete request.')
+@click.option('--rate', default=2.0, type=click.FloatRange(0.01), help='Delete requests per second at most.')
+@click.option('--limit', default=0, help='Objects to delete at most, 0 for no limit.')
+@click.option('--dry-run', is_flag=True, help='Print the orphaned keys without deleting them.')
+def collect_orphans(prefixes, min_age, batch_size, rate, limit, dry_run):
+    """
+    Delete stored objects no row references: uploads of failed requests,
+    images of discarded smears, replaced profile images and stale sprites
+    """
+    start = time.perf_counter()
+    counters = orphans.collect(app, prefixes or orphans.PREFIXES, min_age * 3600, dry_run, batch_size, rate, limit)
+    print('{} referenced keys, {} objects listed, {} too recent, {} orphans, {} referenced again'.format(
+        counters['referenced_keys'], counters['listed'], counters['recent'], counters['orphans'], counters['reused']))
+    print('{} {} objects ({:.1f} MB), {} failed in {:.1f} s'.format(
+        'would delete' if dry_run else 'deleted', counters['deleted'], counters['deleted_bytes'] / 1e6,
+        counters['failed'], time.perf_counter() - start))
@@ -0,0 +1,133 @@
+import io
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+from flask_testing import TestCase
+from PIL import Image
+from app import create_app, db
+from app.cache import user_cache
+from app.presence import visit_tracker
+from app.storage import storage
+from app.models import User, Role, Clinic, Provider, Patient, Order, Sample, Smear, Event, PathReview, CellImage
+from app.utils import Gender, FluidType, OrderName, ProviderDegree, OrderEventType, InstrumentType
+
+
+class HemogramTestCase(TestCase):
+    """
+    Fresh schema with the preset roles and a logged in admin for each test
+    TEST_DATABASE_URL must point to an empty PostgreSQL database
+    """
+
+    def create_app(self):
+        return create_app('testing')
+
+    def setUp(self):
+        db.create_all()
+        Role.preset_roles()
+        self.user = User(username='tester', user_first_name='Test', user_last_name='User',
+                         email='tester@example.com', password='tester', account_confirmed=True,
+                         role=Role.query.filter_by(name='Admin').first())
+        db.session.add(self.user)
+        db.session.commit()
+        user_cache.clear()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(self.user.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        # buffered visits would be written once the schema is dropped
+        with visit_tracker.lock:
+            visit_tracker.pending.clear()
+            visit_tracker.seen.clear()
+        db.session.remove()
+        db.drop_all()
+
+
+class LocalStorageTestCase(HemogramTestCase):
+    """
+    HemogramTestCase storing files in a temporary STORAGE_LOCAL_ROOT
+    """
+
+    def create_app(self):
+        app = super().create_app()
+        self.root = tempfile.mkdtemp()
+        app.config.update(STORAGE_BACKEND='local', STORAGE_LOCAL_ROOT=self.root)
+        storage.init_app(app)
+        return app
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.root)
+
+
+def add_samples(user, count, pathrv=False):
+    """
+    Add count orders, each with its events, a sample and a smear
+    returns the samples
+    """
+    clinic = Clinic.query.filter_by(clinic_code_name='TEST').first()
+    if clinic is None:
+        clinic = Clinic(clinic_code_name='TEST', clinic_full_name='Test Clinic', added_by=user.id)
+        db.session.add(clinic)
+    provider = Provider(pro_first_name='Test', pro_last_name='Provider', pro_middle_name='',
+                        degree=ProviderDegree.MD, added_by=user.id)
+    patient = Patient(pat_first_name='Test', pat_last_name='Patient', pat_middle_name='',
+                      birth_date=datetime(1980, 1, 1), gender=Gender.FEMALE, registered_by=user.id)
+    db.session.add_all([provider, patient])
+    samples = []
+    for _ in range(count):
+        order = Order(order_fluid_type=FluidType.WHOLE_BLOOD, order_name=OrderName.CBD, donor=patient,
+                      ordering_location=clinic, ordering_provider=provider)
+        sample = Sample(wbc=7.5, rbc=4.5, hgb=14.0, hct=42, plt=250, pathrv=pathrv, order=order)
+        db.session.add_all([order, sample, Smear(instrument_type=InstrumentType.CELLAVISION, parent_sample=sample),
+                            Event(order=order, user_id=user.id, event_detail=OrderEventType.CREATED),
+                            Event(order=order, user_id=user.id, event_detail=OrderEventType.RECEIVED_SAMPLE)])
+        if pathrv:
+            db.session.add(PathReview(smear=sample, review_for='test'))
+        samples.append(sample)
+    db.session.commit()
+    return samples
+
+
+def add_images(smear, classes):
+    """
+    Add one image row per class index of classes to a smear
+    returns the images
+    """
+    images = [CellImage(img='slide_images/test-{}-{}.jpg'.format(smear.id, i), smear_id=smear.id,
+                        nucleated_cell_class=cell_class) for i, cell_class in enumerate(classes)]
+    db.session.add_all(images)
+    db.session.commit()
+    return images
+
+
+def jpeg(color, size=(40, 30)):
+    """
+    Bytes of a JPEG image of one color
+    """
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class QueryCounter:
+    """
+    Count the statements run by the calling thread, statements
+    of background threads (visit tracker, pending hub) are left out
+    """
+
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.count = 0
+
+    def __enter__(self):
+        db.event.listen(db.engine, 'before_cursor_execute', self.before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc):
+        db.event.remove(db.engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self.thread:
+            self.count += 1
@@ -0,0 +1,34 @@
+from app import db
+from app.cellavision import import_images
+from app.models import SmearClassCount
+from app.utils import wbc_classification
+from tests.base import LocalStorageTestCase, add_images, add_samples, jpeg
+
+
+class ImportImagesTest(LocalStorageTestCase):
+    """
+    CellaVision exports imported into smears
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.smear = add_samples(self.user, 1)[0].smears.first()
+
+    def counts(self):
+        db.session.expire_all()
+        return {row.cell_class: row.cells for row in SmearClassCount.query.filter_by(smear_id=self.smear.id)
+                if row.cells}
+
+    def test_class_folders(self):
+        imported, failed = import_images(self.app, [('Neutrophil/1.jpg', jpeg('red')),
+                                                    ('Lymphocyte/2.jpg', jpeg('blue'))], self.user.id, self.smear)
+        self.assertEqual((imported, failed), ({self.smear.id: 2}, []))
+        classes = wbc_classification()
+        self.assertEqual(self.counts(), {classes.index('neutrophils'): 1, classes.index('lymphocytes'): 1})
+
+    def test_smear_without_counters(self):
+        add_images(self.smear, [0, 0, 1])
+        SmearClassCount.query.filter_by(smear_id=self.smear.id).delete()
+        db.session.commit()
+        import_images(self.app, [('Lymphocyte/1.jpg', jpeg('red'))], self.user.id, self.smear)
+        self.assertEqual(self.counts(), {0: 2, 1: 1, wbc_classification().index('lymphocytes'): 1})
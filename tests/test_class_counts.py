@@ -0,0 +1,67 @@
+from app import db
+from app.models import CellImage, SmearClassCount
+from app.utils import wbc_classification
+from tests.base import HemogramTestCase, add_images, add_samples
+
+
+class ClassCountsTest(HemogramTestCase):
+    """
+    Per-class counters of smears stored before the counters existed
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.smear = add_samples(self.user, 1)[0].smears.first()
+        self.images = add_images(self.smear, [0, 1, 1, 2])
+        SmearClassCount.query.filter_by(smear_id=self.smear.id).delete()
+        db.session.commit()
+
+    def stored(self):
+        db.session.rollback()
+        return {row.cell_class: row.cells for row in SmearClassCount.query.filter_by(smear_id=self.smear.id)}
+
+    def test_tuples_builds_without_commit(self):
+        self.assertEqual(SmearClassCount.tuples(self.smear.id), [(0, 1), (1, 2), (2, 1)])
+        self.assertEqual(self.stored(), {})
+
+    def test_build_twice(self):
+        SmearClassCount.build(self.smear.id)
+        SmearClassCount.build(self.smear.id)
+        self.assertEqual(SmearClassCount.tuples(self.smear.id), [(0, 1), (1, 2), (2, 1)])
+
+    def test_live_diff_keeps_counters(self):
+        response = self.client.get('/lab/smears/{}/diff/live'.format(self.smear.id))
+        self.assert200(response)
+        classes = wbc_classification()
+        self.assertEqual(response.json['counts'], {classes[0]: 1, classes[1]: 2, classes[2]: 1})
+        self.assertEqual(self.stored(), {0: 1, 1: 2, 2: 1})
+
+    def test_classify_counts_every_class(self):
+        classes = wbc_classification()
+        response = self.client.post('/lab/smears/{}/classify'.format(self.smear.id),
+                                    json={'version': 0, 'changes': [[self.images[0].id, classes[2]]]})
+        self.assert200(response)
+        self.assertEqual({cell_class: cells for cell_class, cells in self.stored().items() if cells},
+                         {1: 2, 2: 2})
+
+    def test_single_change(self):
+        classes = wbc_classification()
+        response = self.client.get('/lab/samples/diff_value?id={}&box={}'.format(self.images[0].id, classes[3]))
+        self.assert200(response)
+        self.assertEqual(self.stored(), {0: 0, 1: 2, 2: 1, 3: 1})
+        self.assertEqual(SmearClassCount.tuples(self.smear.id), [(1, 2), (2, 1), (3, 1)])
+
+    def test_image_added_and_deleted(self):
+        db.session.add(CellImage(img='slide_images/added.jpg', smear_id=self.smear.id, nucleated_cell_class=2))
+        db.session.delete(self.images[1])
+        db.session.commit()
+        self.assertEqual(self.stored(), {0: 1, 1: 1, 2: 2})
+
+    def test_every_image_deleted(self):
+        for image in self.images:
+            db.session.delete(image)
+        db.session.commit()
+        self.assertEqual({cell_class: cells for cell_class, cells in self.stored().items() if cells}, {})
+        db.session.add(CellImage(img='slide_images/added.jpg', smear_id=self.smear.id, nucleated_cell_class=1))
+        db.session.commit()
+        self.assertEqual(SmearClassCount.tuples(self.smear.id), [(1, 1)])
@@ -0,0 +1,59 @@
+from app import db
+from app.models import CellImage, Smear, SmearClassCount
+from app.utils import wbc_classification
+from tests.base import HemogramTestCase, add_images, add_samples
+
+
+class ClassifyCellsTest(HemogramTestCase):
+    """
+    Batched reclassification of diff cells with the smear version check
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.sample = add_samples(self.user, 1)[0]
+        self.smear = self.sample.smears.first()
+        self.images = add_images(self.smear, [0, 1, 1])
+        self.classes = wbc_classification()
+
+    def classify(self, version, changes):
+        return self.client.post('/lab/smears/{}/classify'.format(self.smear.id),
+                                json={'version': version, 'changes': changes})
+
+    def counts(self):
+        db.session.expire_all()
+        return {row.cell_class: row.cells for row in SmearClassCount.query.filter_by(smear_id=self.smear.id)
+                if row.cells}
+
+    def test_batch(self):
+        response = self.classify(0, [[self.images[0].id, self.classes[2]], [self.images[1].id, self.classes[2]]])
+        self.assert200(response)
+        self.assertEqual(response.json, {'version': 1, 'updated': 2})
+        db.session.expire_all()
+        self.assertEqual([image.nucleated_cell_class for image in CellImage.query.order_by(CellImage.id)], [2, 2, 1])
+        self.assertEqual(self.counts(), {1: 1, 2: 2})
+
+    def test_stale_version(self):
+        self.assert200(self.classify(0, []))
+        response = self.classify(0, [[self.images[0].id, self.classes[2]]])
+        self.assertStatus(response, 409)
+        self.assertEqual(response.json['version'], 1)
+        db.session.expire_all()
+        self.assertEqual(CellImage.query.get(self.images[0].id).nucleated_cell_class, 0)
+
+    def test_validated_sample(self):
+        self.sample.status = True
+        db.session.commit()
+        self.assertStatus(self.classify(0, [[self.images[0].id, self.classes[2]]]), 409)
+
+    def test_single_change_bumps_version(self):
+        response = self.client.get('/lab/samples/diff_value?id={}&box={}'.format(self.images[0].id, self.classes[3]))
+        self.assert200(response)
+        self.assertEqual(response.data, b'3')
+        db.session.expire_all()
+        self.assertEqual(Smear.query.get(self.smear.id).version, 1)
+        self.assertEqual(self.counts(), {1: 2, 3: 1})
+        self.assertStatus(self.classify(0, [[self.images[1].id, self.classes[2]]]), 409)
+
+    def test_single_change_unknown_class(self):
+        self.assert400(self.client.get('/lab/samples/diff_value?id={}&box=none'.format(self.images[0].id)))
@@ -0,0 +1,43 @@
+from app import db
+from app.models import Sample
+from tests.base import HemogramTestCase, add_samples
+
+REPORT = {'diff': {'wbc': [('neutrophils', {'relative': 60.0, 'absolute': 4.5, 'seq': 1}),
+                           ('lymphocytes', {'relative': 40.0, 'absolute': 3.0, 'seq': 2})],
+                   'nrbcs': {'relative': 1.0, 'absolute': 0.1}},
+          'total': 100, 'morph': []}
+
+
+class DifferentialTest(HemogramTestCase):
+    """
+    Validated differential stored as diff_results rows and the legacy pickled report
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.sample_id = add_samples(self.user, 1)[0].id
+
+    def load(self):
+        db.session.expunge_all()
+        return Sample.query.get(self.sample_id)
+
+    def test_store_diff(self):
+        sample = self.load()
+        sample.store_diff(REPORT)
+        db.session.commit()
+        self.assertEqual(self.load().differential(), REPORT)
+
+    def test_legacy_report(self):
+        sample = self.load()
+        sample.diff_report = REPORT
+        db.session.commit()
+        self.assertEqual(self.load().differential(), REPORT)
+
+    def test_report_deferred(self):
+        sample = self.load()
+        sample.diff_report = REPORT
+        sample.store_diff(REPORT)
+        db.session.commit()
+        sample = self.load()
+        sample.differential()
+        self.assertNotIn('diff_report', sample.__dict__)
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+from sqlalchemy.exc import OperationalError
+from app.hotfolder import HotFolder
+from tests.base import HemogramTestCase, add_samples
+
+
+class HotFolderTest(HemogramTestCase):
+    """
+    Watcher of the directories instruments export smears to
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.watcher = HotFolder(self.app, [self.directory], self.user.id,
+                                 os.path.join(self.directory, '.checkpoint.json'))
+
+    def tearDown(self):
+        self.watcher.pool.shutdown(wait=True)
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def test_order_id(self):
+        names = {'1234_smear.zip': 1234, '1234.tar.gz': 1234, '1234': 1234,
+                 '2024-05-01_1234.zip': None, 'ORD-1234_smear.zip': None, 'smear.zip': None}
+        self.assertEqual({name: self.watcher.order_id(name) for name in names}, names)
+
+    def test_unnamed_export_skipped(self):
+        add_samples(self.user, 1)
+        os.mkdir(os.path.join(self.directory, '2024-05-01_1'))
+        open(os.path.join(self.directory, '2024-05-01_1', self.app.config['HOTFOLDER_MARKER']), 'w').close()
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.watcher.poll()
+            self.watcher.poll()
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('No order id', logs.output[0])
+        self.assertEqual(self.watcher.running, {})
+
+    def test_poll_error_logged(self):
+        self.watcher.stable = 0
+        polls = []
+
+        def poll():
+            polls.append(1)
+            if len(polls) == 1:
+                raise OperationalError('SELECT 1', {}, Exception('server closed the connection'))
+
+        self.watcher.poll = poll
+        with self.assertLogs(self.app.logger, 'ERROR'):
+            self.watcher.run(0, once=True)
+        self.assertEqual(len(polls), 2)
@@ -0,0 +1,26 @@
+from unittest import mock
+from app import utils
+from tests.base import HemogramTestCase
+
+
+class ImagePoolTest(HemogramTestCase):
+    """
+    Processes of the image pool are never forked from the threaded worker
+    """
+
+    def test_forkserver(self):
+        self.assertEqual(utils.get_image_pool()._mp_context.get_start_method(), 'forkserver')
+
+    def test_start_method_of_python_36(self):
+        with mock.patch.object(utils.sys, 'version_info', (3, 6, 9)), \
+                mock.patch.object(utils.multiprocessing, 'set_start_method') as set_start_method, \
+                mock.patch.object(utils.multiprocessing, 'get_start_method', return_value='forkserver'):
+            utils.init_image_pool(self.app)
+        set_start_method.assert_called_once_with('forkserver')
+
+    def test_start_method_already_set(self):
+        with mock.patch.object(utils.sys, 'version_info', (3, 6, 9)), \
+                mock.patch.object(utils.multiprocessing, 'set_start_method', side_effect=RuntimeError), \
+                mock.patch.object(utils.multiprocessing, 'get_start_method', return_value='fork'), \
+                self.assertLogs(self.app.logger, 'WARNING'):
+            utils.init_image_pool(self.app)
@@ -0,0 +1,87 @@
+import io
+import os
+from werkzeug.datastructures import FileStorage
+from app import db, orphans
+from app.models import CellImage
+from app.storage import storage
+from app.utils import store_images
+from tests.base import LocalStorageTestCase, add_samples, jpeg
+
+
+class CollectOrphansTest(LocalStorageTestCase):
+    """
+    Deletion of the stored objects no row references
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.smears = [sample.smears.first() for sample in add_samples(self.user, 2)]
+        self.smear = self.smears[0]
+
+    def collect(self, **kwargs):
+        kwargs.setdefault('min_age', 0)
+        return orphans.collect(self.app, rate=1000, echo=lambda key: None, **kwargs)
+
+    def keys(self, prefix):
+        return sorted(key for key, _, _ in storage.list(prefix))
+
+    def store(self, smear, data):
+        files = [FileStorage(io.BytesIO(data), filename='cell.jpg', content_type='image/jpeg')]
+        uploaded, failed = store_images(files, stored=lambda checksums: CellImage.stored(smear.id, checksums))
+        self.assertEqual(failed, [])
+        image = CellImage(smear_id=smear.id, **uploaded[0][1])
+        db.session.add(image)
+        db.session.commit()
+        return image
+
+    def age(self, keys):
+        for key in keys:
+            os.utime(storage.driver.path(key), (0, 0))
+
+    def test_images(self):
+        image = self.store(self.smear, jpeg('red'))
+        image_keys = sorted([image.img, image.img_grid, image.img_medium])
+        orphan = 'slide_images/{}.jpg'.format('0' * 32)
+        legacy = 'slide_images/0123456789abcdef.jpg'
+        for key in (orphan, legacy):
+            storage.put(key, b'image', 'image/jpeg')
+        counters = self.collect(prefixes=['slide_images/'])
+        self.assertEqual((counters['listed'], counters['deleted']), (5, 2))
+        self.assertEqual(self.keys('slide_images/'), image_keys)
+
+    def test_referenced_by_checksum(self):
+        image = self.store(self.smear, jpeg('red'))
+        orphan = 'slide_images/{}.jpg'.format('0' * 32)
+        self.assertEqual(orphans.referenced([image.img, image.img_grid, orphan, 'default.jpg']),
+                         {image.img, image.img_grid, 'default.jpg'})
+
+    def test_reused_objects_touched(self):
+        first = self.store(self.smear, jpeg('red'))
+        keys = [first.img, first.img_grid, first.img_medium]
+        self.age(keys)
+        second = self.store(self.smears[1], jpeg('red'))
+        self.assertEqual(second.img, first.img)
+        db.session.delete(first)
+        db.session.delete(second)
+        db.session.commit()
+        counters = self.collect(prefixes=['slide_images/'], min_age=3600)
+        self.assertEqual((counters['recent'], counters['deleted']), (3, 0))
+
+    def test_deleted_object_stored_again(self):
+        first = self.store(self.smear, jpeg('red'))
+        storage.delete_many([first.img, first.img_grid, first.img_medium])
+        second = self.store(self.smears[1], jpeg('red'))
+        self.assertEqual(storage.read(second.img), jpeg('red'))
+        self.assertEqual(len(self.keys('slide_images/')), 3)
+
+    def test_sprite_atlases(self):
+        current = 'sprites/{}-new-0.jpg'.format(self.smear.id)
+        stale = 'sprites/{}-old-0.jpg'.format(self.smear.id)
+        self.smear.sprite = {'digest': 'new', 'atlases': [{'key': current, 'width': 10, 'height': 10}],
+                             'cells': {'1': [0, 0, 0, 10, 10]}}
+        db.session.commit()
+        for key in (current, stale):
+            storage.put(key, b'atlas', 'image/jpeg')
+        counters = self.collect(prefixes=['sprites/'])
+        self.assertEqual((counters['listed'], counters['deleted']), (2, 1))
+        self.assertEqual(self.keys('sprites/'), [current])
@@ -0,0 +1,47 @@
+import io
+from werkzeug.datastructures import FileStorage
+from app import db
+from app.models import CellImage, PackEntry
+from app.storage import storage
+from app.utils import Pack, store_images
+from tests.base import LocalStorageTestCase, add_samples, jpeg
+
+
+class PackedSmearTest(LocalStorageTestCase):
+    """
+    Images of an upload stored as one pack object and served by range reads
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.packed, self.loose = [sample.smears.first() for sample in add_samples(self.user, 2)]
+        self.data = jpeg('red')
+
+    def store(self, smear, pack=None):
+        files = [FileStorage(io.BytesIO(self.data), filename='cell.jpg', content_type='image/jpeg')]
+        uploaded, failed = store_images(files, pack=pack,
+                                        stored=lambda checksums: CellImage.stored(smear.id, checksums))
+        self.assertEqual(failed, [])
+        if pack and pack.key:
+            PackEntry.store(PackEntry.rows(smear.id, pack))
+        image = CellImage(smear_id=smear.id, **uploaded[0][1])
+        db.session.add(image)
+        db.session.commit()
+        return image
+
+    def test_cell_from_pack(self):
+        image = self.store(self.packed, Pack())
+        url = '/lab/smears/{}/cells/{}'.format(self.packed.id, image.img)
+        response = self.client.get(url)
+        self.assert200(response)
+        self.assertEqual(response.data, self.data)
+        self.assertStatus(self.client.get(url, headers={'If-None-Match': '"{}"'.format(image.img)}), 304)
+        self.assertFalse([key for key, _, _ in storage.list('slide_images/')])
+
+    def test_packed_keys_not_reused(self):
+        packed = self.store(self.packed, Pack())
+        known, in_smear = CellImage.stored(self.loose.id, [packed.checksum])
+        self.assertEqual((known, in_smear), ({}, set()))
+        self.assertEqual(CellImage.stored(self.packed.id, [packed.checksum]), ({}, {packed.checksum}))
+        loose = self.store(self.loose)
+        self.assertEqual(storage.read(loose.img), self.data)
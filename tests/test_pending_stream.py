@@ -0,0 +1,40 @@
+from werkzeug.test import EnvironBuilder
+from app.stream import pending_hub
+from tests.base import HemogramTestCase
+
+
+class PendingStreamTest(HemogramTestCase):
+    """
+    Streams of a worker are capped, clients over the cap poll instead
+    """
+
+    def tearDown(self):
+        with pending_hub.lock:
+            pending_hub.subscribers.clear()
+        super().tearDown()
+
+    def test_stream(self):
+        response = self.client.get('/lab/json/pending/stream', buffered=False)
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(len(pending_hub.subscribers), 1)
+        self.assertEqual(next(response.response), 'retry: 2000\n\n'.encode())
+        response.close()
+        self.assertEqual(len(pending_hub.subscribers), 0)
+
+    def test_closed_before_start(self):
+        # the server closes the response without reading it, eg- the client left
+        environ = EnvironBuilder('/lab/json/pending/stream').get_environ()
+        self.client.cookie_jar.inject_wsgi(environ)
+        app_iter = self.app.wsgi_app(environ, lambda status, headers: None)
+        self.assertEqual(len(pending_hub.subscribers), 1)
+        app_iter.close()
+        self.assertEqual(len(pending_hub.subscribers), 0)
+
+    def test_refused_over_cap(self):
+        self.app.config['PENDING_STREAM_MAX_SUBSCRIBERS'] = 2
+        with pending_hub.lock:
+            pending_hub.subscribers.update([object(), object()])
+        response = self.client.get('/lab/json/pending/stream')
+        self.assertStatus(response, 204)
+        self.assertEqual(len(pending_hub.subscribers), 2)
@@ -0,0 +1,30 @@
+import io
+from unittest import mock
+from flask import get_flashed_messages
+from app.models import User
+from app.storage import storage
+from tests.base import LocalStorageTestCase
+
+
+class EditProfileTest(LocalStorageTestCase):
+    """
+    Profile image upload of the edit profile page
+    """
+
+    def post(self):
+        return self.client.post('/edit_profile', content_type='multipart/form-data',
+                                data={'username': 'tester', 'user_image': (io.BytesIO(b'image'), 'me.jpg')})
+
+    def test_stored(self):
+        self.assertRedirects(self.post(), '/edit_profile')
+        key = User.query.get(self.user.id).profile_image
+        self.assertTrue(key.startswith('profile_images/'))
+        self.assertEqual(storage.read(key), b'image')
+
+    def test_storage_failure_keeps_image(self):
+        with self.client:
+            with mock.patch.object(storage, 'put', side_effect=OSError('unreachable')), \
+                    self.assertLogs(self.app.logger, 'ERROR'):
+                self.assertRedirects(self.post(), '/edit_profile')
+            self.assertIn('danger', [category for category, _ in get_flashed_messages(with_categories=True)])
+        self.assertEqual(User.query.get(self.user.id).profile_image, 'default.jpg')
@@ -0,0 +1,39 @@
+from flask import render_template
+from app import db, sprites
+from app.models import Smear
+from app.utils import wbc_classification
+from tests.base import HemogramTestCase, add_images, add_samples
+
+
+class SpriteManifestTest(HemogramTestCase):
+    """
+    Diff grid drawn from the atlases of the sprite manifest
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['SPRITE_ATLAS'] = True
+        self.smear = add_samples(self.user, 1)[0].smears.first()
+        self.images = add_images(self.smear, [1, 1])
+        key = 'sprites/{}-0.jpg'.format(self.smear.id)
+        # the second image is not in the atlas
+        self.smear.sprite = {'digest': sprites.digest(image.id for image in self.images),
+                             'atlases': [{'key': key, 'width': 20, 'height': 10}],
+                             'cells': {str(self.images[0].id): [0, 10, 0, 10, 10]}}
+        db.session.commit()
+
+    def test_diff_grid(self):
+        smear = Smear.query.get(self.smear.id)
+        cell_groups = smear.image_groups(wbc_classification())
+        sprite = sprites.manifest(self.app, smear, [image.id for image in self.images])
+        with self.app.test_request_context():
+            html = render_template('_cell_grid.html', smear=smear, cell_groups=cell_groups, sprite=sprite)
+        self.assertEqual(html.count('sprite-cell sprite-0'), 1)
+        self.assertIn('background-position: -10px -0px', html)
+        self.assertIn(self.images[1].img, html)
+
+    def test_sprite_route(self):
+        response = self.client.get('/lab/smears/{}/sprite'.format(self.smear.id))
+        self.assert200(response)
+        self.assertEqual(response.json['cells'], {str(self.images[0].id): [0, 10, 0, 10, 10]})
+        self.assertIn('url', response.json['atlases'][0])
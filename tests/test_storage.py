@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+import boto3
+from botocore.stub import Stubber
+from app.storage import LocalStorage, put_new_file_to_s3, touch_file_in_s3
+
+
+class PutNewTest(unittest.TestCase):
+    """
+    Objects stored under keys derived from their content
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.local = LocalStorage(type('App', (), {'config': {'STORAGE_LOCAL_ROOT': self.root,
+                                                              'STORAGE_ACCEL_REDIRECT': None}}))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_s3_existing_skipped(self):
+        s3 = boto3.client('s3', region_name='us-east-1', aws_access_key_id='key', aws_secret_access_key='secret')
+        key = {'Bucket': 'bucket', 'Key': 'slide_images/a.jpg'}
+        with Stubber(s3) as stubber:
+            stubber.add_client_error('head_object', '404', expected_params=key)
+            stubber.add_response('put_object', {})
+            self.assertTrue(put_new_file_to_s3(s3, 'bucket', b'image', key['Key'], 'private', 'image/jpeg', 3600))
+            # a retry finds the object, a put_object call would fail the stubber
+            stubber.add_response('head_object', {'LastModified': datetime.now(timezone.utc),
+                                                 'ContentType': 'image/jpeg'}, key)
+            self.assertFalse(put_new_file_to_s3(s3, 'bucket', b'image', key['Key'], 'private', 'image/jpeg', 3600))
+            stubber.assert_no_pending_responses()
+
+    def test_local_existing_refreshed(self):
+        self.assertTrue(self.local.put_new('slide_images/a.jpg', b'image'))
+        path = self.local.path('slide_images/a.jpg')
+        os.utime(path, (0, 0))
+        self.assertFalse(self.local.put_new('slide_images/a.jpg', b'image'))
+        self.assertGreater(os.stat(path).st_mtime, 0)
+        self.assertEqual(self.local.read('slide_images/a.jpg'), b'image')
+
+    def test_s3_touch_keeps_headers(self):
+        s3 = boto3.client('s3', region_name='us-east-1', aws_access_key_id='key', aws_secret_access_key='secret')
+        key = {'Bucket': 'bucket', 'Key': 'slide_images/a_grid.webp'}
+        head = {'ContentType': 'image/webp', 'CacheControl': 'max-age=31536000', 'Metadata': {'source': 'upload'}}
+        with Stubber(s3) as stubber:
+            stubber.add_response('head_object', dict(head, LastModified=datetime.now(timezone.utc)), key)
+            self.assertFalse(touch_file_in_s3(s3, 'bucket', key['Key'], 'private', 3600))
+            stubber.add_response('head_object', dict(head, LastModified=datetime.now(timezone.utc) - timedelta(days=2)),
+                                 key)
+            stubber.add_response('copy_object', {}, dict(key, CopySource=key, MetadataDirective='REPLACE',
+                                                         ACL='private', **head))
+            self.assertTrue(touch_file_in_s3(s3, 'bucket', key['Key'], 'private', 3600))
+            stubber.assert_no_pending_responses()
@@ -0,0 +1,37 @@
+from tests.base import HemogramTestCase, QueryCounter, add_samples
+
+
+class WorklistQueriesTest(HemogramTestCase):
+    """
+    Sample and review worklists load a page in a constant number of queries
+    """
+
+    def count_queries(self, url):
+        with QueryCounter() as counter:
+            response = self.client.get(url)
+        self.assert200(response)
+        return counter.count, response.json['data']
+
+    def assert_flat(self, url, pathrv):
+        # first request loads the logged in user into the user cache
+        self.client.get(url)
+        add_samples(self.user, 3, pathrv)
+        few, rows = self.count_queries(url)
+        self.assertEqual(len(rows), 3)
+        add_samples(self.user, 40, pathrv)
+        many, rows = self.count_queries(url)
+        self.assertEqual(len(rows), 43)
+        self.assertEqual(few, many)
+
+    def test_samples(self):
+        self.assert_flat('/lab/samples/json/all?draw=1&start=0&length=100', pathrv=False)
+
+    def test_reviews(self):
+        self.assert_flat('/lab/samples/reviews/json/all?draw=1&start=0&length=100', pathrv=True)
+
+    def test_rows(self):
+        sample = add_samples(self.user, 1, pathrv=True)[0]
+        _, rows = self.count_queries('/lab/samples/reviews/json/pending?draw=1')
+        self.assertEqual([row['id'] for row in rows], [sample.id])
+        self.assertEqual(sorted(rows[0]['events']), ['CREATED', 'RECEIVED_SAMPLE'])
+        self.assertIs(rows[0]['path_status'], False)